@@ -86,7 +86,15 @@ def register_commands(app):
     app.cli.add_command(commands.createdb)
     app.cli.add_command(commands.seed)
     app.cli.add_command(commands.flushrdb)
+    app.cli.add_command(commands.migrate_props)
+    app.cli.add_command(commands.reprice)
+    app.cli.add_command(commands.index_attributes)
+    app.cli.add_command(commands.build_artist_paths)
+    app.cli.add_command(commands.build_primary_images)
     app.cli.add_command(commands.reindex)
+    app.cli.add_command(commands.bench_codec)
+    app.cli.add_command(commands.cache_stats)
+    app.cli.add_command(commands.cache_warm)
 
 
 def load_plugins(app):
@@ -1,7 +1,8 @@
 from flask import flash
 from flask_login import current_user
 
-from flaskshop.corelib.mc import cache, rdb
+from flaskshop.corelib.loader import batch, batched
+from flaskshop.corelib.mc import cache, invalidate
 from flaskshop.database import Column, Model, db
 from flaskshop.discount.models import Voucher
 from flaskshop.product.models import ProductVariant, Product
@@ -9,6 +10,14 @@ from flaskshop.product.models import ProductVariant, Product
 MC_KEY_CART_BY_USER = "checkout:cart:user_id:{}"
 
 
+def _load_variants(lines):
+    return batch(ProductVariant.get_multi([line.variant_id for line in lines]))
+
+
+def _load_products(lines):
+    return batch(Product.get_multi([line.product_id for line in lines]))
+
+
 class Cart(Model):
     __tablename__ = "checkout_cart"
     user_id = Column(db.Integer())
@@ -31,7 +40,7 @@ class Cart(Model):
 
     @property
     def lines(self):
-        return CartLine.query.filter(CartLine.cart_id == self.id).all()
+        return batch(CartLine.query.filter(CartLine.cart_id == self.id).all())
 
     @classmethod
     @cache(MC_KEY_CART_BY_USER.format("{user_id}"))
@@ -74,7 +83,7 @@ class Cart(Model):
     def get_product_price(self, product_id):
         price = 0
         for line in self:
-            if line.product.id == product_id:
+            if line.product_id == product_id:
                 price += line.subtotal
         return price
 
@@ -124,17 +133,17 @@ class Cart(Model):
 
     @classmethod
     def __flush_insert_event__(cls, target):
-        rdb.delete(MC_KEY_CART_BY_USER.format(current_user.id))
+        invalidate(MC_KEY_CART_BY_USER.format(current_user.id))
 
     @classmethod
     def __flush_after_update_event__(cls, target):
         super().__flush_after_update_event__(target)
-        rdb.delete(MC_KEY_CART_BY_USER.format(current_user.id))
+        invalidate(MC_KEY_CART_BY_USER.format(current_user.id))
 
     @classmethod
     def __flush_delete_event__(cls, target):
         super().__flush_delete_event__(target)
-        rdb.delete(MC_KEY_CART_BY_USER.format(current_user.id))
+        invalidate(MC_KEY_CART_BY_USER.format(current_user.id))
 
 
 class CartLine(Model):
@@ -152,10 +161,12 @@ class CartLine(Model):
         return self.variant.is_shipping_required
 
     @property
+    @batched(_load_variants)
     def variant(self):
         return ProductVariant.get_by_id(self.variant_id)
 
     @property
+    @batched(_load_products)
     def product(self):
         return Product.get_by_id(self.product_id)
 
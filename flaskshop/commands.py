@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 """Click commands."""
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import chain
 from pathlib import Path
 from subprocess import call
@@ -7,11 +11,24 @@ from subprocess import call
 import click
 from flask import current_app
 from flask.cli import with_appcontext
+from redis.exceptions import RedisError
 from werkzeug.exceptions import MethodNotAllowed, NotFound
 
-from flaskshop.corelib.db import rdb
+from flaskshop.corelib.codec import CODECS
+from flaskshop.corelib.db import convert_props_key, rdb
+from flaskshop.corelib.mc_stats import get_stats, reset
+from flaskshop.corelib.paginator import KeysetPagination
+from flaskshop.corelib.utils import RateLimiter
 from flaskshop.extensions import db
-from flaskshop.product.models import Product
+from flaskshop.product.models import (
+    Artist,
+    Collection,
+    Product,
+    ProductCollection,
+    index_attributes as index_products,
+    rebuild_artist_paths,
+    update_primary_images,
+)
 from flaskshop.public.search import Item
 from flaskshop.random_data import (
     create_admin,
@@ -209,6 +226,64 @@ def flushrdb():
     rdb.flushdb()
 
 
+@click.command()
+@with_appcontext
+def migrate_props():
+    """Convert json blob props keys into redis hashes."""
+    converted = 0
+    for key in rdb.scan_iter(match="/bran/*/props", count=1000):
+        converted += convert_props_key(key)
+    click.echo(f"Converted {converted} props keys.")
+
+
+@click.command()
+@with_appcontext
+def reprice():
+    """Recompute the discount and effective price of every product."""
+    from flaskshop.discount.models import reprice as reprice_products
+
+    repriced = reprice_products(db.session)
+    db.session.commit()
+    click.echo(f"Repriced {repriced} products.")
+
+
+@click.command()
+@click.option("--chunk", default=1000, help="Products indexed per statement")
+@with_appcontext
+def index_attributes(chunk):
+    """Rebuild the product attribute index used by the listing filters."""
+    ids = [id for id, in Product.query.with_entities(Product.id).order_by(Product.id)]
+    chunks = [ids[i:i + chunk] for i in range(0, len(ids), chunk)]
+    with click.progressbar(chunks, label="Indexing") as bar:
+        for chunk_ids in bar:
+            index_products(db.session, chunk_ids)
+            db.session.commit()
+    click.echo(f"Indexed {len(ids)} products.")
+
+
+@click.command()
+@with_appcontext
+def build_artist_paths():
+    """Compute the hierarchy path of every artist from the parent ids."""
+    built = rebuild_artist_paths(db.session)
+    db.session.commit()
+    click.echo(f"Built the paths of {built} artists.")
+
+
+@click.command()
+@click.option("--chunk", default=1000, help="Products updated per statement")
+@with_appcontext
+def build_primary_images(chunk):
+    """Store the first image path of every product for the listings."""
+    ids = [id for id, in Product.query.with_entities(Product.id).order_by(Product.id)]
+    chunks = [ids[i:i + chunk] for i in range(0, len(ids), chunk)]
+    with click.progressbar(chunks, label="Updating") as bar:
+        for chunk_ids in bar:
+            update_primary_images(db.session, chunk_ids)
+            db.session.commit()
+    click.echo(f"Updated {len(ids)} products.")
+
+
 @click.command()
 @with_appcontext
 def reindex():
@@ -217,3 +292,163 @@ def reindex():
     Item.init()
     products = Product.query.all()
     Item.bulk_update(products, op_type="create")
+
+
+@click.command()
+@click.option("--num", default=50, help="How many products and artists to sample")
+@click.option("--rounds", default=100, help="Decode rounds for every payload")
+@with_appcontext
+def bench_codec(num, rounds):
+    """Compare payload size and decode time of the cache codecs."""
+    products = Product.query.limit(num).all()
+    artists = Artist.query.limit(num).all()
+    with current_app.test_request_context():
+        families = {
+            "product": products,
+            "images": [product.images for product in products],
+            "variant": [product.variant for product in products],
+            "artist page": [
+                Artist.get_product_by_artist.original_function(Artist, artist.id, 1)
+                for artist in artists
+            ],
+        }
+        click.echo(f"{'family':12}  {'codec':10}  {'bytes/entry':>11}  {'decode us':>9}")
+        for family, values in families.items():
+            if not values:
+                continue
+            for name, codec in CODECS.items():
+                payloads = [codec.dumps(value) for value in values]
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    for payload in payloads:
+                        codec.loads(payload)
+                elapsed = time.perf_counter() - start
+                size = sum(len(payload) for payload in payloads) / len(payloads)
+                decode_us = elapsed / rounds / len(payloads) * 1_000_000
+                click.echo(f"{family:12}  {name:10}  {size:11.0f}  {decode_us:9.1f}")
+
+
+@click.command()
+@click.option("--reset", "reset_", is_flag=True, help="Clear the counters")
+@with_appcontext
+def cache_stats(reset_):
+    """Show cache hit rate, compute time and payload size per key family."""
+    try:
+        if reset_:
+            reset()
+            click.echo("Cache stats cleared.")
+            return
+        stats = get_stats()
+    except RedisError as e:
+        click.echo(f"Cache stats unavailable, redis failed: {e}")
+        return
+    click.echo(
+        f"{'family':48}  {'hits':>8}  {'misses':>8}  {'neg':>6}  {'bypass':>6}  "
+        f"{'hit %':>6}  {'ms/miss':>8}  {'bytes':>8}"
+    )
+    for row in stats:
+        click.echo(
+            f"{row['family']:48}  {row['hits']:8}  {row['misses']:8}  "
+            f"{row['negative_hits']:6}  {row['fallbacks']:6}  "
+            f"{row['hit_rate'] * 100:6.1f}  "
+            f"{row['avg_compute_ms']:8.2f}  {row['avg_bytes']:8.0f}"
+        )
+
+
+@click.command()
+@click.option("--pages", default=3, help="Listing pages per artist and collection")
+@click.option("--workers", default=8, help="Threads computing cache entries")
+@click.option("--rate", default=50.0, help="Max computations per second, 0 for none")
+@with_appcontext
+def cache_warm(pages, workers, rate):
+    """Fill the catalog caches: featured products, artist and collection
+    pages, and the images and variants of every product on them."""
+    if not current_app.config["USE_REDIS"]:
+        click.echo("USE_REDIS is off, nothing to warm.")
+        return
+    app = current_app._get_current_object()
+    limiter = RateLimiter(rate)
+    lock = threading.Lock()
+    # family -> [calls, errors, seconds]
+    timings = defaultdict(lambda: [0, 0, 0.0])
+
+    def warm_one(family, query, func, *args):
+        limiter.wait()
+        start = time.perf_counter()
+        try:
+            # cache_by_args keys depend on the request args, warm the urls of
+            # the pages as the listings link them
+            with app.test_request_context("/", query_string=query):
+                return func(*args)
+        except Exception:
+            with lock:
+                timings[family][1] += 1
+            return None
+        finally:
+            with lock:
+                timings[family][0] += 1
+                timings[family][2] += time.perf_counter() - start
+
+    def run(label, jobs):
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(warm_one, *job) for job in jobs]
+            with click.progressbar(length=len(futures), label=label) as bar:
+                for _ in as_completed(futures):
+                    bar.update(1)
+        return [future.result() for future in futures]
+
+    started = time.perf_counter()
+    listings = [
+        ("artist pages", {}, Artist.get_product_by_artist, artist.id, 1)
+        for artist in Artist.query
+    ] + [
+        ("collection pages", {}, ProductCollection.get_product_by_collection, c.id, 1)
+        for c in Collection.query
+    ]
+    [featured, *first_pages] = run(
+        "listings", [("featured", {}, Product.get_featured_product), *listings]
+    )
+
+    def next_page(job, ctx):
+        family, _, func, object_id, _ = job
+        pagination = ctx["pagination"]
+        if isinstance(pagination, KeysetPagination):
+            return family, {"cursor": pagination.next_cursor}, func, object_id, 1
+        page = pagination.next_num
+        return family, {"page": page}, func, object_id, page
+
+    # a keyset page is only reachable from the cursor of the one before it,
+    # so the listings are walked one page at a time
+    more_ctxs = []
+    jobs, ctxs = listings, first_pages
+    for page in range(2, pages + 1):
+        jobs = [
+            next_page(job, ctx)
+            for job, ctx in zip(jobs, ctxs)
+            if ctx and ctx["pagination"].has_next
+        ]
+        if not jobs:
+            break
+        ctxs = run(f"page {page}", jobs)
+        more_ctxs.extend(ctxs)
+
+    products = {p.id: p for p in featured or []}
+    for ctx in chain(first_pages, more_ctxs):
+        products.update((p.id, p) for p in (ctx or {}).get("products", []))
+    run(
+        "products",
+        [
+            job
+            for product in products.values()
+            for job in (
+                ("product", {}, Product.get_by_id, product.id),
+                ("product images", {}, lambda p: p.images, product),
+                ("product variants", {}, lambda p: p.variant, product),
+            )
+        ],
+    )
+
+    click.echo(f"{'family':18}  {'calls':>6}  {'errors':>6}  {'seconds':>8}")
+    for family, (calls, errors, seconds) in timings.items():
+        click.echo(f"{family:18}  {calls:6}  {errors:6}  {seconds:8.2f}")
+    click.echo(f"Warmed in {time.perf_counter() - started:.1f}s.")
@@ -0,0 +1,146 @@
+"""Codecs for the values corelib.mc keeps in redis."""
+import importlib
+import io
+import pickle
+import zlib
+
+from sqlalchemy import inspect
+from sqlalchemy.ext import serializer
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import instance_state
+
+
+class CodecError(Exception):
+    """the payload was written for another schema, treat it as a cache miss"""
+
+
+class SerializerCodec:
+    """the legacy format, whole mapped instances through sqlalchemy.ext.serializer"""
+
+    magic = b""
+
+    def dumps(self, value):
+        return serializer.dumps(value)
+
+    def loads(self, data):
+        return serializer.loads(data)
+
+
+class ModelLayout:
+    def __init__(self, model):
+        mapper = inspect(model)
+        self.model = model
+        self.new_instance = mapper.class_manager.new_instance
+        self.ref = f"{model.__module__}:{model.__qualname__}"
+        self.keys = tuple(attr.key for attr in mapper.column_attrs)
+        schema = ",".join(
+            f"{attr.key}:{attr.columns[0].type!r}" for attr in mapper.column_attrs
+        )
+        self.schema_hash = zlib.crc32(f"{self.ref}|{schema}".encode())
+        # built once, so pickle memoizes ref across every instance of a payload
+        self.header = ("m", self.ref, self.schema_hash)
+
+    def dump(self, obj):
+        values = tuple(getattr(obj, key) for key in self.keys)
+        # MutableDict and friends pickle with their change tracking, plain is enough
+        values = tuple(dict(v) if isinstance(v, dict) else v for v in values)
+        return self.header + (values,)
+
+    def load(self, values):
+        obj = self.new_instance()
+        # loaded values go straight to the committed state, like a query row does
+        instance_state(obj).dict.update(zip(self.keys, values))
+        make_transient_to_detached(obj)
+        return obj
+
+
+class ModelCodec:
+    """pickles mapped instances as (model, schema hash, column values) tuples
+
+    Mapped instances are swapped for plain tuples wherever they appear, so lists
+    of models and dicts such as the artist pagination context are handled too.
+    Loading rebuilds detached instances; a payload whose schema hash no longer
+    matches the model raises CodecError.
+    """
+
+    magic = b"\x01mc"
+
+    def __init__(self):
+        # type -> ModelLayout, or None for types that are not mapped
+        self._layouts = {}
+        self._refs = {}
+
+    def layout(self, cls):
+        try:
+            return self._layouts[cls]
+        except KeyError:
+            mapper = inspect(cls, raiseerr=False)
+            is_model = mapper is not None and hasattr(mapper, "column_attrs")
+            layout = ModelLayout(cls) if is_model else None
+            self._layouts[cls] = layout
+            if layout is not None:
+                self._refs[layout.ref] = layout
+            return layout
+
+    def layout_by_ref(self, ref):
+        layout = self._refs.get(ref)
+        if layout is None:
+            module, _, qualname = ref.partition(":")
+            try:
+                model = getattr(importlib.import_module(module), qualname)
+            except (ImportError, AttributeError):
+                raise CodecError(f"unknown model {ref}")
+            layout = self.layout(model)
+        return layout
+
+    def dumps(self, value):
+        buf = io.BytesIO()
+        buf.write(self.magic)
+        _ModelPickler(buf, self).dump(value)
+        return buf.getvalue()
+
+    def loads(self, data):
+        buf = io.BytesIO(data)
+        buf.seek(len(self.magic))
+        return _ModelUnpickler(buf, self).load()
+
+
+class _ModelPickler(pickle.Pickler):
+    def __init__(self, file, codec):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.codec = codec
+
+    def persistent_id(self, obj):
+        layout = self.codec.layout(type(obj))
+        return layout.dump(obj) if layout is not None else None
+
+
+class _ModelUnpickler(pickle.Unpickler):
+    def __init__(self, file, codec):
+        super().__init__(file)
+        self.codec = codec
+
+    def persistent_load(self, pid):
+        _, ref, schema_hash, values = pid
+        layout = self.codec.layout_by_ref(ref)
+        if layout is None or layout.schema_hash != schema_hash:
+            raise CodecError(f"schema of {ref} changed")
+        return layout.load(values)
+
+
+CODECS = {
+    "model": ModelCodec(),
+    "serializer": SerializerCodec(),
+}
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+def loads(data):
+    """decode with whichever codec wrote data, unmarked payloads are legacy"""
+    for codec in CODECS.values():
+        if codec.magic and data[: len(codec.magic)] == codec.magic:
+            return codec.loads(data)
+    return CODECS["serializer"].loads(data)
@@ -2,12 +2,37 @@ import copy
 import json
 from datetime import datetime
 
-from redis import Redis
+from redis import BlockingConnectionPool, Redis
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ResponseError, WatchError
+from redis.retry import Retry
 
 from flaskshop.corelib.local_cache import lc
 from flaskshop.settings import Config
 
-rdb = Redis.from_url(Config.REDIS_URL)
+rdb = Redis(
+    connection_pool=BlockingConnectionPool.from_url(
+        Config.REDIS_URL,
+        max_connections=Config.REDIS_MAX_CONNECTIONS,
+        timeout=Config.REDIS_POOL_TIMEOUT,
+        socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=Config.REDIS_SOCKET_CONNECT_TIMEOUT,
+        retry_on_timeout=bool(Config.REDIS_RETRIES),
+        retry=Retry(ExponentialBackoff(cap=0.1, base=0.01), Config.REDIS_RETRIES),
+    )
+)
+
+
+def subscriber():
+    """a client for pub/sub, whose connection idles between messages far longer
+    than the socket timeout of rdb allows; health checks find dead ones"""
+    return Redis.from_url(
+        Config.REDIS_URL,
+        socket_connect_timeout=Config.REDIS_SOCKET_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=30,
+    )
+
 
 if not Config.USE_REDIS:
 
@@ -17,11 +42,16 @@ if not Config.USE_REDIS:
             pass
 
         def __getattr__(self, name):
-            pass
+            # every other redis command (incr, get...) is a no-op as well
+            return self.delete
 
         def delete(self, *args, **kwargs):
             pass
 
+        def pipeline(self, *args, **kwargs):
+            # commands queued on a pipeline are no-ops too
+            return self
+
         def __iter__(self):
             yield 1
 
@@ -29,7 +59,45 @@ if not Config.USE_REDIS:
     rdb.keys = Fake
 
 
+# clamps at min_val, so concurrent decrements can not go below it
+DECR_PROPS_SCRIPT = """
+local n = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if n < tonumber(ARGV[2]) then
+    n = tonumber(ARGV[2])
+    redis.call('HSET', KEYS[1], ARGV[1], n)
+end
+return n
+"""
+
+
+def _decr_props(key, field, min_val):
+    return rdb.eval(DECR_PROPS_SCRIPT, 1, key, field, min_val)
+
+
+def convert_props_key(key):
+    """turn a legacy json blob props key into a hash of json encoded fields,
+    returns False if the key is not a blob"""
+    with rdb.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                if pipe.type(key) != b"string":
+                    pipe.unwatch()
+                    return False
+                props = json.loads(pipe.get(key) or "{}")
+                pipe.multi()
+                pipe.delete(key)
+                if props:
+                    pipe.hset(key, mapping={k: json.dumps(v) for k, v in props.items()})
+                pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+
 class PropsMixin:
+    """props live in one redis hash per object, a json encoded value per field"""
+
     @property
     def _props_name(self):
         return f"__{self.get_uuid()}/props_cached"
@@ -38,16 +106,38 @@ class PropsMixin:
     def _props_db_key(self):
         return f"{self.get_uuid()}/props"
 
+    def _props_command(self, command, *args, **kwargs):
+        """run command(props key, ...)"""
+        try:
+            return command(self._props_db_key, *args, **kwargs)
+        except ResponseError as e:
+            # written by the blob format and not migrated yet
+            if not str(e).startswith("WRONGTYPE"):
+                raise
+            convert_props_key(self._props_db_key)
+            return command(self._props_db_key, *args, **kwargs)
+
+    def _cached_props(self):
+        """(whether every field is loaded, the fields loaded so far)"""
+        return lc.get(self._props_name) or (False, {})
+
     def _get_props(self):
-        props = lc.get(self._props_name)
-        if props is None:
-            props = rdb.get(self._props_db_key) or ""
-            props = json.loads(props) if props else {}
-            lc.set(self._props_name, props)
-        return props
+        complete, props = self._cached_props()
+        if not complete:
+            props = self._props_command(rdb.hgetall) or {}
+            props = {k.decode(): json.loads(v) for k, v in props.items()}
+            lc.set(self._props_name, (True, props))
+        return dict(props)
 
     def _set_props(self, props):
-        rdb.set(self._props_db_key, json.dumps(props))
+        pipe = rdb.pipeline()
+        pipe.delete(self._props_db_key)
+        if props:
+            pipe.hset(
+                self._props_db_key,
+                mapping={k: json.dumps(v) for k, v in props.items()},
+            )
+        pipe.execute()
         lc.delete(self._props_name)
 
     def _destroy_props(self):
@@ -59,35 +149,71 @@ class PropsMixin:
 
     props = property(_get_props, _set_props)
 
+    def _prime_props(self, props, keys, values):
+        """add HMGET results to the fields cached in lc"""
+        props = dict(props)
+        # misses are remembered too, the next read of them needs no round trip
+        props.update(
+            (key, json.loads(value) if value is not None else None)
+            for key, value in zip(keys, values)
+        )
+        lc.set(self._props_name, (False, props))
+        return props
+
+    def get_props_items(self, keys, default=None):
+        """several props with one HMGET, fields loaded before are not fetched"""
+        complete, props = self._cached_props()
+        missing = [key for key in keys if key not in props]
+        if missing and not complete:
+            values = self._props_command(rdb.hmget, missing) or [None] * len(missing)
+            props = self._prime_props(props, missing, values)
+        return {
+            key: default if props.get(key) is None else props[key] for key in keys
+        }
+
+    @staticmethod
+    def prefetch_props(objs, keys):
+        """load props keys of every obj in one pipelined round trip and prime lc,
+        so reading them afterwards needs no redis call"""
+        if not (Config.USE_REDIS and objs and keys):
+            return
+        pipe = rdb.pipeline(transaction=False)
+        for obj in objs:
+            pipe.hmget(obj._props_db_key, keys)
+        for obj, values in zip(objs, pipe.execute(raise_on_error=False)):
+            if isinstance(values, ResponseError):
+                # a legacy blob, converted and loaded on its own
+                obj.get_props_items(keys)
+                continue
+            complete, props = obj._cached_props()
+            if not complete:
+                obj._prime_props(props, keys, values)
+
     def get_props_item(self, key, default=None):
-        return self.props.get(key, default)
+        return self.get_props_items([key], default)[key]
 
     def set_props_item(self, key, value):
-        props = self.props
-        props[key] = value
-        self.props = props
+        self._props_command(rdb.hset, key, json.dumps(value))
+        lc.delete(self._props_name)
 
     def delete_props_item(self, key):
-        props = self.props
-        props.pop(key, None)
-        self.props = props
+        self._props_command(rdb.hdel, key)
+        lc.delete(self._props_name)
 
     def update_props(self, data):
-        props = self.props
-        props.update(data)
-        self.props = props
+        if data:
+            mapping = {k: json.dumps(v) for k, v in data.items()}
+            self._props_command(rdb.hset, mapping=mapping)
+        lc.delete(self._props_name)
 
     def incr_props_item(self, key):
-        n = self.get_props_item(key, 0)
-        n += 1
-        self.set_props_item(key, n)
+        n = self._props_command(rdb.hincrby, key, 1)
+        lc.delete(self._props_name)
         return n
 
     def decr_props_item(self, key, min_val=0):
-        n = self.get_props_item(key, 0)
-        n -= 1
-        n = n if n > min_val else min_val
-        self.set_props_item(key, n)
+        n = self._props_command(_decr_props, key, min_val)
+        lc.delete(self._props_name)
         return n
 
 
@@ -0,0 +1,41 @@
+"""Batch the lazy lookups of objects that are rendered together.
+
+A listing registers its objects with `batch`. The first time a `batched`
+property is read on one of them, the value is loaded for every object of
+the batch at once, so a page costs a fixed number of queries however many
+items it shows.
+"""
+import functools
+
+
+def batch(objs):
+    """register objs as rendered together, returns objs"""
+    group = [obj for obj in objs if obj is not None]
+    for obj in group:
+        obj._batch = group
+    return objs
+
+
+def batched(load_many):
+    """property body decorator, load_many(objs) returns the values of objs in
+    order; they are kept as `_<name>` on each object. Objects outside of a
+    batch keep using the decorated function."""
+
+    def deco(f):
+        attr = f"_{f.__name__}"
+
+        @functools.wraps(f)
+        def _(self):
+            if hasattr(self, attr):
+                return getattr(self, attr)
+            group = getattr(self, "_batch", None)
+            if group is None:
+                return f(self)
+            pending = [obj for obj in group if not hasattr(obj, attr)]
+            for obj, value in zip(pending, load_many(pending)):
+                setattr(obj, attr, value)
+            return getattr(self, attr)
+
+        return _
+
+    return deco
@@ -1,21 +1,84 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flaskshop.settings import Config
+
+
+def sizeof(value):
+    """approximate memory footprint of value in bytes, follows containers"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sizeof(v) for v in value)
+    return size
+
+
 class LocalCache:
-    def __init__(self, size=10000):
-        self.dataset = {}
+    """Process-local LRU cache with per-entry ttl and an approximate byte budget.
+
+    Least recently used entries are evicted one by one once either `size`
+    entries or `max_bytes` bytes are exceeded, instead of wiping the dataset.
+    """
+
+    def __init__(self, size=10000, max_bytes=64 * 1024 * 1024, expire=0):
+        # key -> (value, expire_at, nbytes), ordered from oldest to newest use
+        self.dataset = OrderedDict()
         self.size = size
+        self.max_bytes = max_bytes
+        self.expire = expire
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
 
     def clear(self):
-        self.dataset.clear()
+        with self._lock:
+            self.dataset.clear()
+            self.nbytes = 0
+
+    def _pop(self, key):
+        item = self.dataset.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[2]
+        return item
 
-    def _cache(self, key, value):
-        if len(self.dataset) >= self.size:
-            self.clear()
-        self.dataset[key] = value
+    def _cache(self, key, value, expire):
+        nbytes = sizeof(key) + sizeof(value)
+        expire_at = time.monotonic() + expire if expire else 0
+        with self._lock:
+            self._pop(key)
+            self.dataset[key] = (value, expire_at, nbytes)
+            self.nbytes += nbytes
+            while self.dataset and (
+                len(self.dataset) > self.size or self.nbytes > self.max_bytes
+            ):
+                self._pop(next(iter(self.dataset)))
+                self.evictions += 1
 
     def __repr__(self):
         return "<LocalCache>"
 
+    def __len__(self):
+        return len(self.dataset)
+
     def get(self, key):
-        return self.dataset.get(key)
+        with self._lock:
+            item = self.dataset.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expire_at, _ = item
+            if expire_at and expire_at <= time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return None
+            self.dataset.move_to_end(key)
+            self.hits += 1
+            return value
 
     def get_multi(self, keys):
         return dict((k, self.get(k)) for k in keys)
@@ -24,26 +87,39 @@ class LocalCache:
         return [self.get(k) for k in keys]
 
     def set(self, key, value, time=0, compress=True):
-        self._cache(key, value)
+        self._cache(key, value, time or self.expire)
         return True
 
+    def stats(self):
+        return {
+            "items": len(self.dataset),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
     def __getattr__(self, name):
         if name in ("add", "replace", "delete", "incr", "decr", "prepend", "append"):
 
             def func(key, *args, **kwargs):
-                self.dataset.pop(key, None)
+                with self._lock:
+                    self._pop(key)
                 return True
 
             return func
         elif name in ("append_multi", "prepend_multi", "delete_multi"):
 
             def func2(keys, *args, **kwargs):
-                for k in keys:
-                    self.dataset.pop(k, None)
+                with self._lock:
+                    for k in keys:
+                        self._pop(k)
                 return True
 
             return func2
         raise AttributeError(name)
 
 
-lc = LocalCache()
+lc = LocalCache(
+    Config.LOCAL_CACHE_SIZE, Config.LOCAL_CACHE_MAX_BYTES, Config.LOCAL_CACHE_EXPIRE
+)
@@ -1,14 +1,253 @@
 import functools
 import inspect
+import json
+import math
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
 from pickle import UnpicklingError
+from urllib.parse import urlencode
 
 from flask import current_app, request
-from sqlalchemy.ext.serializer import dumps, loads
+from redis.exceptions import LockError, RedisError
 
-from flaskshop.corelib.db import rdb
-from flaskshop.corelib.utils import Empty, empty
+from flaskshop.corelib.codec import CodecError, get_codec, loads
+from flaskshop.corelib.db import rdb, subscriber
+from flaskshop.corelib.local_cache import LocalCache
+from flaskshop.corelib.mc_stats import family_of, record
+from flaskshop.corelib.utils import Empty, config_value
+from flaskshop.settings import Config
 
 BUILTIN_TYPES = (int, bytes, str, float, bool)
+# a cached None, one byte instead of a pickled Empty
+NEGATIVE = b"\x00"
+MC_KEY_NAMESPACE = "mc:namespace:{}"
+MC_KEY_LOCK = "{}:lock"
+MC_KEY_XFETCH = "{}:xfetch"
+MC_CHANNEL_INVALIDATE = "mc:invalidate"
+# request args that never change a page, only used when no whitelist is given
+TRACKING_ARGS = {"fbclid", "gclid", "msclkid", "_ga", "ref"}
+TRACKING_ARGS_PREFIX = "utm_"
+
+# per-worker L1 in front of redis, it keeps the raw redis payloads rather than
+# loaded objects, so no mapped instance is ever shared between requests
+l1 = LocalCache(Config.MC_L1_SIZE, Config.MC_L1_MAX_BYTES, Config.MC_L1_EXPIRE)
+_l1_lock = threading.Lock()
+_l1_listener_pid = None
+
+
+def _listen_invalidation():
+    client = subscriber()
+    pubsub = None
+    while True:
+        try:
+            if pubsub is not None:
+                pubsub.close()
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(MC_CHANNEL_INVALIDATE)
+            # messages published while we were not subscribed are lost
+            l1.clear()
+            while True:
+                # wakes up every second, so the health check pings can run
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    l1.delete_multi(json.loads(message["data"]))
+        except Exception:
+            time.sleep(1)
+
+
+def use_l1():
+    global _l1_listener_pid
+    if not (current_app.config["USE_REDIS"] and config_value("MC_L1_ENABLED")):
+        return False
+    # started lazily, so every forked worker gets its own subscriber
+    if _l1_listener_pid != os.getpid():
+        with _l1_lock:
+            if _l1_listener_pid != os.getpid():
+                l1.clear()
+                threading.Thread(target=_listen_invalidation, daemon=True).start()
+                _l1_listener_pid = os.getpid()
+    return True
+
+
+class CircuitBreaker:
+    """after repeated redis errors, skip redis for a cool-down period so a slow
+    or dead redis degrades the site to database speed instead of hanging it"""
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return time.monotonic() >= self.open_until
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            # once the cool-down is over a single failure opens it again
+            if (
+                self.failures >= config_value("MC_BREAKER_THRESHOLD")
+                and self.allow()
+            ):
+                cooldown = config_value("MC_BREAKER_COOLDOWN")
+                self.open_until = time.monotonic() + cooldown
+                current_app.logger.warning(
+                    "redis failed %s times, bypass the cache for %ss",
+                    self.failures,
+                    cooldown,
+                )
+
+
+breaker = CircuitBreaker()
+
+
+def mc_get(key):
+    if not use_l1():
+        return rdb.get(key)
+    r = l1.get(key)
+    if r is None:
+        r = rdb.get(key)
+        if r is not None:
+            l1.set(key, r)
+    return r
+
+
+def mc_get_multi(keys):
+    """payloads of keys in order, with one MGET for everything not in the L1"""
+    if not keys:
+        return []
+    if not use_l1():
+        return rdb.mget(keys)
+    found = l1.get_multi(keys)
+    missing = [key for key in keys if found[key] is None]
+    if missing:
+        for key, r in zip(missing, rdb.mget(missing)):
+            if r is not None:
+                l1.set(key, r)
+                found[key] = r
+    return [found[key] for key in keys]
+
+
+def expire_for(value, expire=None):
+    """negative entries always expire, so probing missing ids can not fill redis"""
+    if value != NEGATIVE:
+        return expire
+    negative_expire = config_value("MC_NEGATIVE_EXPIRE")
+    return min(expire, negative_expire) if expire else negative_expire
+
+
+def mc_set_multi(mapping, expire=None):
+    """store several payloads in one pipelined round trip"""
+    pipe = rdb.pipeline(transaction=False)
+    for key, value in mapping.items():
+        pipe.set(key, value, expire_for(value, expire))
+    pipe.execute()
+
+
+def mc_set(key, value, expire=None, force=False):
+    rdb.set(key, value, expire_for(value, expire))
+    if force:
+        # other workers may still hold the value being replaced
+        publish_invalidation([key])
+
+
+class PendingInvalidation:
+    """keys and namespaces cleared during a transaction, applied once it commits"""
+
+    def __init__(self):
+        self.keys = set()
+        self.namespaces = set()
+
+    def clear(self):
+        self.keys.clear()
+        self.namespaces.clear()
+
+    def execute(self):
+        """delete every key and bump every namespace in one pipelined round trip"""
+        if not (self.keys or self.namespaces):
+            return
+        if not current_app.config["USE_REDIS"]:
+            self.clear()
+            return
+        namespace_keys = [MC_KEY_NAMESPACE.format(ns) for ns in self.namespaces]
+        try:
+            pipe = rdb.pipeline(transaction=False)
+            if self.keys:
+                pipe.delete(*self.keys)
+            for key in namespace_keys:
+                pipe.incr(key)
+            pipe.execute()
+            publish_invalidation([*self.keys, *namespace_keys])
+        except RedisError:
+            # the transaction is committed already, failing it now helps nobody
+            breaker.failure()
+            current_app.logger.exception("cache invalidation failed: %s", self.keys)
+        self.clear()
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_invalidation(pending):
+    """make invalidate and bump_namespace collect into pending instead"""
+    previous = getattr(_deferred, "pending", None)
+    _deferred.pending = pending
+    try:
+        yield pending
+    finally:
+        _deferred.pending = previous
+
+
+def invalidate(*keys):
+    """delete keys from redis and from the L1 of every worker"""
+    pending = getattr(_deferred, "pending", None)
+    if pending is not None:
+        pending.keys.update(keys)
+        return
+    rdb.delete(*keys)
+    publish_invalidation(keys)
+
+
+def publish_invalidation(keys):
+    if use_l1():
+        l1.delete_multi(keys)
+        rdb.publish(MC_CHANNEL_INVALIDATE, json.dumps(list(keys)))
+
+
+def get_namespace_version(namespace):
+    """current generation of a key family, 0 until it is bumped for the first time"""
+    version = mc_get(MC_KEY_NAMESPACE.format(namespace))
+    return int(version) if version else 0
+
+
+def namespaced_key(key, namespace):
+    """bake the current generation of namespace into key"""
+    return f"{key}:v{get_namespace_version(namespace)}"
+
+
+def bump_namespace(namespace):
+    """invalidate every key of the family with one INCR instead of KEYS + DEL,
+    old generations are never read again and age out with MC_NAMESPACE_EXPIRE"""
+    pending = getattr(_deferred, "pending", None)
+    if pending is not None:
+        pending.namespaces.add(namespace)
+        return None
+    key = MC_KEY_NAMESPACE.format(namespace)
+    version = rdb.incr(key)
+    publish_invalidation([key])
+    return version
+
+
+def normalize_key(key):
+    """key as the cache decorators store it, without spaces"""
+    return key.replace(" ", "_")
 
 
 def gen_key_factory(key_pattern, arg_names, defaults):
@@ -29,17 +268,166 @@ def gen_key_factory(key_pattern, arg_names, defaults):
             key = key_pattern(*[aa[n] for n in names])
         else:
             key = key_pattern.format(*[aa[n] for n in arg_names], **aa)
-        return key and key.replace(" ", "_"), aa
+        return key and normalize_key(key), aa
 
     return gen_key
 
 
-def cache(key_pattern, expire=None):  # noqa: C901
+def gen_args_key(query_args=None):
+    """canonical query string of the request args a cached view depends on
+
+    query_args maps arg names to their type (or is a callable returning such a
+    mapping), values that are missing, empty or fail to convert are dropped.
+    Without query_args every arg except tracking parameters is kept.
+    """
+    if callable(query_args):
+        query_args = query_args()
+    if query_args is None:
+        params = (
+            (name, value)
+            for name, value in request.args.items(multi=True)
+            if name not in TRACKING_ARGS and not name.startswith(TRACKING_ARGS_PREFIX)
+        )
+    else:
+        params = (
+            (name, request.args.get(name, type=type_))
+            for name, type_ in query_args.items()
+        )
+    return urlencode(sorted((n, str(v)) for n, v in params if v not in (None, "")))
+
+
+def dumps(value):
+    return get_codec(config_value("MC_CODEC")).dumps(value)
+
+
+def encode(value):
+    if value is None:
+        return NEGATIVE
+    if not isinstance(value, BUILTIN_TYPES):
+        value = dumps(value)
+    return value
+
+
+def decode(r):
+    if r == NEGATIVE:
+        return None
+    try:
+        r = loads(r)
+    except (TypeError, UnpicklingError):
+        pass
+    if isinstance(r, Empty):
+        r = None
+    return r
+
+
+def decode_hit(r, family):
+    """decode a payload read from the cache and count the hit"""
+    record(family, hits=1, negative_hits=int(r == NEGATIVE))
+    return decode(r)
+
+
+def _should_refresh_early(meta, beta):
+    """XFetch, refresh with a probability that grows as the expiry gets closer
+    and as the value gets more expensive to recompute"""
+    delta, expire_at = (float(v) for v in meta.split(b":"))
+    return time.time() - delta * beta * math.log(1 - random.random()) >= expire_at
+
+
+def _lookup(key, ttl, xfetch):
+    """return the cached payload and, if it is due for an early refresh, the
+    payload to fall back to while somebody else recomputes it"""
+    if not (xfetch and ttl):
+        return mc_get(key), None
+    r, meta = rdb.mget(key, MC_KEY_XFETCH.format(key))
+    if r is not None and meta and _should_refresh_early(meta, xfetch):
+        return None, r
+    return r, None
+
+
+class StoreError(RedisError):
+    """a value was computed but redis failed to store it, payload is the
+    encoded value so the caller can use it instead of computing it again"""
+
+    def __init__(self, payload):
+        super().__init__("failed to store a computed value")
+        self.payload = payload
+
+
+def _compute(f, a, kw, key, ttl, force, xfetch, family):
+    start = time.time()
+    r = encode(f(*a, **kw))
+    delta = time.time() - start
+    size = len(r) if isinstance(r, (bytes, str)) else 0
+    record(family, misses=1, compute_seconds=delta, bytes=size)
+    try:
+        mc_set(key, r, ttl, force)
+        if xfetch and ttl:
+            rdb.set(MC_KEY_XFETCH.format(key), f"{delta}:{time.time() + ttl}", ttl)
+    except RedisError as e:
+        raise StoreError(r) from e
+    return r
+
+
+def _wait_for(key):
+    """poll for the value the lock holder is computing"""
+    deadline = time.time() + config_value("MC_LOCK_WAIT")
+    while time.time() < deadline:
+        time.sleep(config_value("MC_LOCK_POLL"))
+        r = mc_get(key)
+        if r is not None:
+            return r
+    return None
+
+
+def _cached_call(f, a, kw, key, ttl, family, single_flight=False, xfetch=0):
+    force = kw.pop("force", False)
+    r, stale = _lookup(key, ttl, xfetch) if not force else (None, None)
+    if r is not None:
+        try:
+            return decode_hit(r, family)
+        except CodecError:
+            # written for an older schema, recompute and overwrite it
+            force = True
+    if not single_flight:
+        return decode(_compute(f, a, kw, key, ttl, force, xfetch, family))
+
+    lock = rdb.lock(
+        MC_KEY_LOCK.format(key), timeout=config_value("MC_LOCK_TIMEOUT")
+    )
+    if lock.acquire(blocking=False):
+        try:
+            return decode(_compute(f, a, kw, key, ttl, force, xfetch, family))
+        finally:
+            try:
+                lock.release()
+            except (LockError, RedisError):
+                # the computation outlived the lock timeout, or redis failed
+                # and the lock expires by itself
+                pass
+    r = stale if stale is not None else _wait_for(key)
+    if r is not None:
+        try:
+            return decode_hit(r, family)
+        except CodecError:
+            pass
+    # the lock holder is too slow, do not keep the request waiting any longer
+    return decode(_compute(f, a, kw, key, ttl, force, xfetch, family))
+
+
+def _fallback(f, a, kw, family):
+    """call f without the cache, counted as a fallback of family"""
+    kw.pop("force", None)
+    record(family, fallbacks=1)
+    return f(*a, **kw)
+
+
+def cache(key_pattern, expire=None, namespace=None, single_flight=False, xfetch=0):
     def deco(f):
         arg_names, varargs, varkw, defaults, *_ = inspect.getfullargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
         gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        gen_namespace = namespace and gen_key_factory(namespace, arg_names, defaults)
 
         @functools.wraps(f)
         def _(*a, **kw):
@@ -48,24 +436,24 @@ def cache(key_pattern, expire=None):  # noqa: C901
             key, args = gen_key(*a, **kw)
             if not key:
                 return f(*a, **kw)
-            force = kw.pop("force", False)
-            r = rdb.get(key) if not force else None
-            if r is None:
-                r = f(*a, **kw)
-                if r is not None:
-                    if not isinstance(r, BUILTIN_TYPES):
-                        r = dumps(r)
-                    rdb.set(key, r, expire)
-                else:
-                    r = dumps(empty)
-                    rdb.set(key, r, expire)
-
+            family = family_of(key_pattern, args)
+            if not breaker.allow():
+                return _fallback(f, a, kw, family)
             try:
-                r = loads(r)
-            except (TypeError, UnpicklingError):
-                pass
-            if isinstance(r, Empty):
-                r = None
+                ttl = expire
+                if gen_namespace:
+                    key = namespaced_key(key, gen_namespace(*a, **kw)[0])
+                    ttl = expire or config_value("MC_NAMESPACE_EXPIRE")
+                r = _cached_call(f, a, kw, key, ttl, family, single_flight, xfetch)
+            except StoreError as e:
+                # f ran already, only storing its value failed
+                breaker.failure()
+                r = decode(e.payload)
+            except RedisError:
+                breaker.failure()
+                return _fallback(f, a, kw, family)
+            else:
+                breaker.success()
             if isinstance(r, bytes):
                 r = r.decode()
             return r
@@ -76,12 +464,20 @@ def cache(key_pattern, expire=None):  # noqa: C901
     return deco
 
 
-def cache_by_args(key_pattern, expire=None):  # noqa: C901
+def cache_by_args(
+    key_pattern,
+    expire=None,
+    namespace=None,
+    single_flight=False,
+    xfetch=0,
+    query_args=None,
+):
     def deco(f):
         arg_names, varargs, varkw, defaults, *_ = inspect.getfullargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
         gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        gen_namespace = namespace and gen_key_factory(namespace, arg_names, defaults)
 
         @functools.wraps(f)
         def _(*a, **kw):
@@ -90,25 +486,25 @@ def cache_by_args(key_pattern, expire=None):  # noqa: C901
             key, args = gen_key(*a, **kw)
             if not key:
                 return f(*a, **kw)
-            key = key + ":" + request.query_string.decode()
-            force = kw.pop("force", False)
-            r = rdb.get(key) if not force else None
-            if r is None:
-                r = f(*a, **kw)
-                if r is not None:
-                    if not isinstance(r, BUILTIN_TYPES):
-                        r = dumps(r)
-                    rdb.set(key, r, expire)
-                else:
-                    r = dumps(empty)
-                    rdb.set(key, r, expire)
-
+            family = family_of(key_pattern, args)
+            if not breaker.allow():
+                return _fallback(f, a, kw, family)
             try:
-                r = loads(r)
-            except (TypeError, UnpicklingError):
-                pass
-            if isinstance(r, Empty):
-                r = None
+                ttl = expire
+                if gen_namespace:
+                    key = namespaced_key(key, gen_namespace(*a, **kw)[0])
+                    ttl = expire or config_value("MC_NAMESPACE_EXPIRE")
+                key = key + ":" + gen_args_key(query_args)
+                r = _cached_call(f, a, kw, key, ttl, family, single_flight, xfetch)
+            except StoreError as e:
+                # f ran already, only storing its value failed
+                breaker.failure()
+                r = decode(e.payload)
+            except RedisError:
+                breaker.failure()
+                return _fallback(f, a, kw, family)
+            else:
+                breaker.success()
             return r
 
         _.original_function = f
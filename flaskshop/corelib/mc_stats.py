@@ -0,0 +1,107 @@
+"""Hit/miss/latency counters of the corelib.mc caches, aggregated by key pattern."""
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from flaskshop.corelib.db import rdb
+from flaskshop.corelib.utils import config_value
+
+MC_KEY_STATS = "mc:stats:{}"
+MC_KEY_STATS_FAMILIES = "mc:stats:families"
+
+_stats = defaultdict(Counter)
+_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def family_of(key_pattern, args):
+    """the key family of a call, get_by_id style patterns are split per model"""
+    if callable(key_pattern):
+        return key_pattern.__qualname__
+    if "cls" in args:
+        return key_pattern.replace("{cls.__name__}", args["cls"].__name__)
+    return key_pattern
+
+
+def record(family, **values):
+    """add hits, misses, negative_hits, fallbacks, compute_seconds or bytes
+    to a family"""
+    if not config_value("MC_STATS_ENABLED"):
+        return
+    with _lock:
+        _stats[family].update(values)
+    interval = config_value("MC_STATS_FLUSH_INTERVAL")
+    if interval and time.time() - _last_flush >= interval:
+        flush()
+
+
+def flush():
+    """move the in-process counters to one redis hash per family"""
+    global _stats, _last_flush
+    with _lock:
+        stats, _stats = _stats, defaultdict(Counter)
+        _last_flush = time.time()
+    if not stats:
+        return
+    pipe = rdb.pipeline(transaction=False)
+    pipe.sadd(MC_KEY_STATS_FAMILIES, *stats)
+    for family, counter in stats.items():
+        for field, value in counter.items():
+            if isinstance(value, float):
+                pipe.hincrbyfloat(MC_KEY_STATS.format(family), field, value)
+            else:
+                pipe.hincrby(MC_KEY_STATS.format(family), field, value)
+    try:
+        pipe.execute()
+    except RedisError:
+        # keep them for the next flush, stats must not break a cache fallback
+        with _lock:
+            for family, counter in stats.items():
+                _stats[family].update(counter)
+
+
+def get_stats():
+    """flushed and in-process counters per family, with derived rates"""
+    merged = defaultdict(Counter)
+    if current_app.config["USE_REDIS"]:
+        families = sorted(f.decode() for f in rdb.smembers(MC_KEY_STATS_FAMILIES))
+        pipe = rdb.pipeline(transaction=False)
+        for family in families:
+            pipe.hgetall(MC_KEY_STATS.format(family))
+        for family, values in zip(families, pipe.execute()):
+            merged[family].update({k.decode(): float(v) for k, v in values.items()})
+    with _lock:
+        for family, counter in _stats.items():
+            merged[family].update(counter)
+
+    rows = []
+    for family, counter in sorted(merged.items()):
+        lookups = counter["hits"] + counter["misses"]
+        misses = counter["misses"]
+        rows.append(
+            {
+                "family": family,
+                "hits": int(counter["hits"]),
+                "misses": int(misses),
+                "negative_hits": int(counter["negative_hits"]),
+                "fallbacks": int(counter["fallbacks"]),
+                "hit_rate": counter["hits"] / lookups if lookups else 0,
+                "avg_compute_ms": counter["compute_seconds"] * 1000 / misses
+                if misses
+                else 0,
+                "avg_bytes": counter["bytes"] / misses if misses else 0,
+            }
+        )
+    return rows
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+    if current_app.config["USE_REDIS"]:
+        families = rdb.smembers(MC_KEY_STATS_FAMILIES)
+        keys = [MC_KEY_STATS.format(f.decode()) for f in families]
+        rdb.delete(MC_KEY_STATS_FAMILIES, *keys)
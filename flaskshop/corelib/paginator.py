@@ -0,0 +1,134 @@
+"""Keyset pagination, pages continue from the sort key of the last row seen.
+
+Unlike OFFSET, a page deep in the listing costs the same as the first one
+and no COUNT(*) is run. The position is carried by opaque cursor tokens.
+"""
+import base64
+import binascii
+import json
+import math
+from decimal import Decimal
+
+from sqlalchemy import and_, or_
+
+# what a cursor may hold, sort keys are encoded as json strings or numbers
+SCALARS = (str, int, float)
+
+
+class KeysetPagination:
+    """one page of a keyset paginated query, like flask_sqlalchemy's
+    Pagination but with cursors instead of page numbers"""
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values, backwards=False):
+    data = json.dumps([int(backwards), *values], default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(backwards, values), raises ValueError for a token we did not make"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(data)
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError(f"bad cursor {cursor!r}") from e
+    if not isinstance(data, list) or not data or data[0] not in (0, 1):
+        raise ValueError(f"bad cursor {cursor!r}")
+    backwards, *values = data
+    return bool(backwards), values
+
+
+def parse_cursor(cursor, columns):
+    """(backwards, values) of a cursor made for columns, values converted to
+    the column types; raises ValueError for any other cursor"""
+    backwards, values = decode_cursor(cursor)
+    if len(values) != len(columns):
+        raise ValueError(f"bad cursor {cursor!r}")
+    if not all(value is None or isinstance(value, SCALARS) for value in values):
+        raise ValueError(f"bad cursor {cursor!r}")
+    try:
+        values = [
+            None if value is None else column.type.python_type(value)
+            for column, value in zip(columns, values)
+        ]
+        finite = all(
+            math.isfinite(value)
+            for value in values
+            if isinstance(value, (float, Decimal))
+        )
+    except (TypeError, ValueError, ArithmeticError) as e:
+        # e.g. "x" where a number is expected
+        raise ValueError(f"bad cursor {cursor!r}") from e
+    if not finite or values[-1] is None:
+        raise ValueError(f"bad cursor {cursor!r}")
+    return backwards, values
+
+
+def _beyond(columns, values, descending):
+    """rows after values in the order of columns, NULL sorts before every
+    value as it does in MySQL and SQLite"""
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        equal = [
+            columns[j].is_(None) if values[j] is None else columns[j] == values[j]
+            for j in range(i)
+        ]
+        if value is None:
+            # going down nothing comes after NULL, going up every value does
+            after = None if descending else column.isnot(None)
+        elif descending:
+            after = or_(column < value, column.is_(None))
+        else:
+            after = column > value
+        if after is not None:
+            clauses.append(and_(*equal, after))
+    return or_(*clauses)
+
+
+def keyset_paginate(query, columns, descending=False, cursor=None, per_page=20):
+    """paginate query ordered by columns, which must end with a unique one such
+    as the id; a cursor that does not parse for columns gives the first page"""
+    backwards, values = False, None
+    if cursor:
+        try:
+            backwards, values = parse_cursor(cursor, columns)
+        except ValueError:
+            backwards, values = False, None
+
+    # a previous page is the next one of the reversed order
+    scan_descending = descending != backwards
+    if values is not None:
+        query = query.filter(_beyond(columns, values, scan_descending))
+    order = [column.desc() if scan_descending else column for column in columns]
+    items = query.order_by(None).order_by(*order).limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = values is not None, more
+
+    def key(item):
+        return [getattr(item, column.key) for column in columns]
+
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = encode_cursor(key(items[-1]))
+    if items and has_prev:
+        prev_cursor = encode_cursor(key(items[0]), backwards=True)
+    return KeysetPagination(items, per_page, next_cursor, prev_cursor)
@@ -6,11 +6,20 @@ import threading
 import time
 import urllib
 
+from flask import current_app
 from sqlalchemy.ext.hybrid import hybrid_property
 
+from flaskshop.settings import Config
+
 _missing = object()
 
 
+def config_value(name):
+    """current_app.config[name], or the default of Config for app configs
+    written before the setting existed"""
+    return current_app.config.get(name, getattr(Config, name))
+
+
 class cached_hybrid_property(hybrid_property):
     def __get__(self, instance, owner):
         if instance is None:
@@ -29,6 +38,24 @@ class ObjectId:
     _inc_lock = threading.Lock()
 
 
+class RateLimiter:
+    """spaces calls to wait() at least 1/rate seconds apart, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            at = max(self.next_at, now)
+            self.next_at = at + self.interval
+        time.sleep(at - now)
+
+
 def generate_id():
     oid = struct.pack(">i", int(time.time()))
     oid += struct.pack(">H", os.getpid() % 0xFFFF)
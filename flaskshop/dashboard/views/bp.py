@@ -39,6 +39,7 @@ from .product import (
     variant_del,
 )
 from .site import (
+    cache_stats,
     config_index,
     dashboard_menus,
     dashboard_menus_manage,
@@ -126,6 +127,7 @@ def flaskshop_load_blueprints(app):
     bp.add_url_rule("/plugin/<id>/disable",
                     view_func=plugin_disable, methods=["POST"])
     bp.add_url_rule("/config", view_func=config_index)
+    bp.add_url_rule("/cache_stats", view_func=cache_stats)
     bp.add_url_rule("/users", view_func=users)
     bp.add_url_rule("/users/<user_id>", view_func=user)
     bp.add_url_rule(
@@ -31,8 +31,8 @@ def index():
         .all()
     )
     top5_products = []
-    for product_id, order_count in hot_product_ids[:5]:
-        p = Product.get_by_id(product_id)
+    top5_ids = [product_id for product_id, _ in hot_product_ids[:5]]
+    for p, (_, order_count) in zip(Product.get_multi(top5_ids), hot_product_ids):
         # product may deleted
         if not p:
             continue
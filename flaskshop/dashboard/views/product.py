@@ -1,6 +1,7 @@
 from flask import redirect, render_template, request, url_for, flash
 from flask_babel import lazy_gettext
 
+from flaskshop.corelib.loader import batch
 from flaskshop.dashboard.forms import (
     AttributeForm,
     ArtistForm,
@@ -225,6 +226,7 @@ def products():
         query = query.filter(Product.created_at <= ended_at)
 
     pagination = query.paginate(page, 10)
+    batch(pagination.items)
     props = {
         "id": lazy_gettext("ID"),
         "title": lazy_gettext("Title"),
@@ -1,8 +1,10 @@
 from flask import flash, redirect, render_template, request, url_for
 from flask_babel import lazy_gettext
+from redis.exceptions import RedisError
 
 from flaskshop.account.utils import admin_required
 from flaskshop.checkout.models import ShippingMethod
+from flaskshop.corelib.mc_stats import get_stats
 from flaskshop.dashboard.forms import (
     DashboardMenuForm,
     ShippingMethodForm,
@@ -252,3 +254,11 @@ def site_setting():
 
 def config_index():
     return render_template("site/index.html")
+
+
+def cache_stats():
+    try:
+        stats = get_stats()
+    except RedisError:
+        stats = None
+    return render_template("site/cache_stats.html", stats=stats)
@@ -1,13 +1,59 @@
 import datetime
+import time
 
-from flaskshop.corelib.mc import cache, rdb
+from flask import current_app, g, has_request_context
+from redis.exceptions import RedisError
 
-from .extensions import db
+from flaskshop.corelib.codec import CodecError
+from flaskshop.corelib.mc import (
+    breaker,
+    cache,
+    decode,
+    decode_hit,
+    encode,
+    invalidate,
+    mc_get_multi,
+    mc_set_multi,
+    normalize_key,
+)
+from flaskshop.corelib.mc_stats import record
+
+from .extensions import db, pending_invalidation
 
 Column = db.Column
 MC_KEY_GET_BY_ID = "global:{}:{}"
 
 
+def is_record_id(record_id):
+    return any(
+        (
+            isinstance(record_id, (str, bytes)) and record_id.isdigit(),
+            isinstance(record_id, (int, float)),
+        )
+    )
+
+
+def identity_map():
+    """per request memo of get_by_id/get_by_title results, so repeated lookups
+    of a row within a request return the same instance; None outside requests"""
+    if not has_request_context():
+        return None
+    if "identity_map" not in g:
+        g.identity_map = {}
+    return g.identity_map
+
+
+def title_key(cls, title):
+    """the key get_by_title caches the row of cls titled title under"""
+    return normalize_key(MC_KEY_GET_BY_ID.format(cls.__name__, title))
+
+
+def is_stale(key):
+    """the session flushed a change that invalidates key once it commits, until
+    then the cached copy is stale for this session and must not be memoized"""
+    return key in pending_invalidation(db.session).keys
+
+
 class CRUDMixin:
     @classmethod
     def create(cls, **kwargs):
@@ -36,17 +82,99 @@ class CRUDMixin:
         return commit and db.session.commit()
 
     @classmethod
-    @cache(MC_KEY_GET_BY_ID.format("{cls.__name__}", "{record_id}"))
     def get_by_id(cls, record_id):
         """Get record by ID."""
-        if any(
-            (
-                isinstance(record_id, (str, bytes)) and record_id.isdigit(),
-                isinstance(record_id, (int, float)),
-            )
-        ):
+        if not is_record_id(record_id):
+            return None
+        if is_stale(MC_KEY_GET_BY_ID.format(cls.__name__, int(record_id))):
             return cls.query.get(int(record_id))
-        return None
+        memo = identity_map()
+        if memo is None:
+            return cls._get_by_id(record_id)
+        key = ("id", cls, int(record_id))
+        if key not in memo:
+            memo[key] = cls._get_by_id(record_id)
+        return memo[key]
+
+    @classmethod
+    @cache(MC_KEY_GET_BY_ID.format("{cls.__name__}", "{record_id}"))
+    def _get_by_id(cls, record_id):
+        return cls.query.get(int(record_id))
+
+    @classmethod
+    def get_multi(cls, ids):
+        """Get records by IDs in input order, with one cache MGET and one IN query."""
+        ids = [int(id) if is_record_id(id) else None for id in ids]
+        memo = identity_map()
+        if memo is None:
+            memo = {}
+        found = {}
+        missing = []
+        stale = []
+        for id in dict.fromkeys(ids):
+            if id is None:
+                continue
+            if is_stale(MC_KEY_GET_BY_ID.format(cls.__name__, id)):
+                stale.append(id)
+            elif ("id", cls, id) in memo:
+                found[id] = memo[("id", cls, id)]
+            else:
+                missing.append(id)
+        found.update(cls._get_multi(missing))
+        memo.update((("id", cls, id), found.get(id)) for id in missing)
+        if stale:
+            found.update((obj.id, obj) for obj in cls.query.filter(cls.id.in_(stale)))
+        return [found.get(id) for id in ids]
+
+    @classmethod
+    def _get_multi(cls, unique_ids):
+        if not unique_ids:
+            return {}
+        if current_app.config["USE_REDIS"] and breaker.allow():
+            try:
+                found = cls._get_multi_cached(unique_ids)
+                breaker.success()
+                return found
+            except RedisError:
+                breaker.failure()
+        return {obj.id: obj for obj in cls.query.filter(cls.id.in_(unique_ids))}
+
+    @classmethod
+    def _get_multi_cached(cls, unique_ids):
+        keys = [MC_KEY_GET_BY_ID.format(cls.__name__, id) for id in unique_ids]
+        family = MC_KEY_GET_BY_ID.format(cls.__name__, "{record_id}")
+        found = {}
+        missing = []
+        for id, r in zip(unique_ids, mc_get_multi(keys)):
+            if r is not None:
+                try:
+                    found[id] = decode_hit(r, family)
+                    continue
+                except CodecError:
+                    pass
+            missing.append(id)
+        if missing:
+            start = time.time()
+            rows = {obj.id: obj for obj in cls.query.filter(cls.id.in_(missing))}
+            delta = time.time() - start
+            payloads = {}
+            for id in missing:
+                payload = encode(rows.get(id))
+                payloads[MC_KEY_GET_BY_ID.format(cls.__name__, id)] = payload
+                # same detached copies as get_by_id hands out
+                found[id] = decode(payload)
+            record(
+                family,
+                misses=len(missing),
+                compute_seconds=delta,
+                bytes=sum(len(p) for p in payloads.values()),
+            )
+            try:
+                mc_set_multi(payloads)
+            except RedisError:
+                # the rows are loaded already, do not let the caller query again
+                breaker.failure()
+        return found
 
     @classmethod
     def get_or_create(cls, **kwargs):
@@ -93,21 +221,41 @@ class CRUDMixin:
         for prop, value in db_props.items():
             obj.set_props_item(prop, value)
 
+    @classmethod
+    def __flush_event__(cls, target):
+        # any insert, update or delete may change what a lookup of cls returns
+        memo = identity_map()
+        if memo:
+            for key in [key for key in memo if key[1] is cls]:
+                del memo[key]
+
     @classmethod
     def __flush_after_update_event__(cls, target):
-        rdb.delete(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
+        invalidate(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
 
     @classmethod
     def __flush_delete_event__(cls, target):
-        rdb.delete(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
+        invalidate(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
 
 
 class Model(CRUDMixin, db.Model):
     """Base model class that includes CRUD convenience methods."""
 
     @classmethod
-    @cache(MC_KEY_GET_BY_ID.format("{cls.__name__}", "{title}"))
     def get_by_title(cls, title):
+        if is_stale(title_key(cls, title)):
+            return cls.query.filter_by(title=title).first()
+        memo = identity_map()
+        if memo is None:
+            return cls._get_by_title(title)
+        key = ("title", cls, title)
+        if key not in memo:
+            memo[key] = cls._get_by_title(title)
+        return memo[key]
+
+    @classmethod
+    @cache(MC_KEY_GET_BY_ID.format("{cls.__name__}", "{title}"))
+    def _get_by_title(cls, title):
         return cls.query.filter_by(title=title).first()
 
     __abstract__ = True
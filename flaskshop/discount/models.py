@@ -3,10 +3,12 @@ import string
 from datetime import datetime
 from decimal import Decimal
 
+from sqlalchemy import case, event, exists, func, or_, select, true, update
+from sqlalchemy.orm import object_session
+
 from flaskshop.constant import DiscountValueTypeKinds, VoucherTypeKinds
-from flaskshop.corelib.mc import rdb
 from flaskshop.database import Column, Model, db
-from flaskshop.product.models import MC_KEY_PRODUCT_DISCOUNT_PRICE, Artist, Product
+from flaskshop.product.models import Artist, Product, products_changed
 
 MC_KEY_SALE_PRODUCT_IDS = "discount:sale:{}:product_ids"
 
@@ -150,6 +152,10 @@ class Sale(Model):
                 artist_id=product.artist.id
             ).first()
             sale = Sale.get_by_id(sale_artist.sale_id) if sale_artist else None
+        return cls.discount_of(product, sale)
+
+    @staticmethod
+    def discount_of(product, sale):
         if sale is None:
             return 0
         if sale.discount_value_type == DiscountValueTypeKinds.fixed.value:
@@ -220,31 +226,20 @@ class Sale(Model):
             db.session.add(new)
         db.session.commit()
 
-    @staticmethod
-    def clear_mc(target):
-        # when update sales, need to update product discounts
-        # for (id,) in target.products_ids:
-        #     rdb.delete(MC_KEY_PRODUCT_DISCOUNT_PRICE.format(id))
-
-        # need to process so many states, artist update etc.. so delete all
-        keys = rdb.keys(MC_KEY_PRODUCT_DISCOUNT_PRICE.format("*"))
-        for key in keys:
-            rdb.delete(key)
-
     @classmethod
     def __flush_insert_event__(cls, target):
         super().__flush_insert_event__(target)
-        target.clear_mc(target)
+        reprice_later(target, sale=target.id)
 
     @classmethod
     def __flush_after_update_event__(cls, target):
         super().__flush_after_update_event__(target)
-        target.clear_mc(target)
+        reprice_later(target, sale=target.id)
 
     @classmethod
     def __flush_delete_event__(cls, target):
         super().__flush_delete_event__(target)
-        target.clear_mc(target)
+        reprice_later(target, sale=target.id)
 
 
 class SaleArtist(Model):
@@ -252,8 +247,119 @@ class SaleArtist(Model):
     sale_id = Column(db.Integer())
     artist_id = Column(db.Integer())
 
+    @classmethod
+    def __flush_event__(cls, target):
+        super().__flush_event__(target)
+        reprice_later(target, artist=target.artist_id)
+
 
 class SaleProduct(Model):
     __tablename__ = "discount_sale_product"
     sale_id = Column(db.Integer())
     product_id = Column(db.Integer())
+
+    @classmethod
+    def __flush_event__(cls, target):
+        super().__flush_event__(target)
+        reprice_later(target, product=target.product_id)
+
+
+def discount_amount_expression():
+    """Sale.get_discounted_price as a sql expression of the product row"""
+    product = Product.__table__
+    product_sale = (
+        select(SaleProduct.sale_id)
+        .where(SaleProduct.product_id == Product.id)
+        .order_by(SaleProduct.id)
+        .limit(1)
+        .correlate(product)
+        .scalar_subquery()
+    )
+    artist_sale = (
+        select(SaleArtist.sale_id)
+        .where(SaleArtist.artist_id == Product.artist_id)
+        .order_by(SaleArtist.id)
+        .limit(1)
+        .correlate(product)
+        .scalar_subquery()
+    )
+    has_product_sale = (
+        exists().where(SaleProduct.product_id == Product.id).correlate(product)
+    )
+    # a product sale wins over an artist sale
+    sale_id = case(
+        (has_product_sale, product_sale),
+        else_=artist_sale,
+    )
+    amount = case(
+        (
+            Sale.discount_value_type == DiscountValueTypeKinds.fixed.value,
+            Sale.discount_value,
+        ),
+        (
+            Sale.discount_value_type == DiscountValueTypeKinds.percent.value,
+            func.round(Product.basic_price * Sale.discount_value / 100, 2),
+        ),
+        else_=0,
+    )
+    sale_amount = (
+        select(amount)
+        .where(Sale.id == sale_id)
+        .correlate(product)
+        .scalar_subquery()
+    )
+    return func.coalesce(sale_amount, 0)
+
+
+def reprice(session, condition=true()):
+    """recompute discount_amount and effective_price of the products matching
+    condition with one UPDATE, returns how many were repriced"""
+    connection = session.connection()
+    product_ids = set(connection.execute(select(Product.id).where(condition)).scalars())
+    if not product_ids:
+        return 0
+    amount = discount_amount_expression()
+    connection.execute(
+        update(Product.__table__)
+        .where(condition)
+        .values(discount_amount=amount, effective_price=Product.basic_price - amount)
+    )
+
+    products_changed(session, product_ids, ["discount_amount", "effective_price"])
+    return len(product_ids)
+
+
+def reprice_later(target, product=None, artist=None, sale=None):
+    """reprice the products whose discount the flush of target may change,
+    once the flush is done"""
+    pending = object_session(target).info.setdefault(
+        "reprice", {"product": set(), "artist": set(), "sale": set()}
+    )
+    for kind, id in (("product", product), ("artist", artist), ("sale", sale)):
+        if id is not None:
+            pending[kind].add(id)
+
+
+@event.listens_for(db.session, "after_flush_postexec")
+def _reprice_after_flush(session, flush_context):
+    pending = session.info.pop("reprice", None)
+    if pending is None or not any(pending.values()):
+        return
+    conditions = []
+    if pending["product"]:
+        conditions.append(Product.id.in_(pending["product"]))
+    if pending["artist"]:
+        conditions.append(Product.artist_id.in_(pending["artist"]))
+    if pending["sale"]:
+        sales = pending["sale"]
+        conditions.append(
+            Product.id.in_(
+                select(SaleProduct.product_id).where(SaleProduct.sale_id.in_(sales))
+            )
+        )
+        conditions.append(
+            Product.artist_id.in_(
+                select(SaleArtist.artist_id).where(SaleArtist.sale_id.in_(sales))
+            )
+        )
+    reprice(session, or_(*conditions))
@@ -12,8 +12,10 @@ from flask_sqlalchemy import DefaultMeta, Model, SQLAlchemy, _QueryProperty
 from flask_wtf.csrf import CSRFProtect
 from sqlalchemy import Column, DateTime, Integer, event
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
+from sqlalchemy.orm import object_session
 
 from flaskshop.corelib.db import PropsItem, PropsMixin
+from flaskshop.corelib.mc import PendingInvalidation, deferred_invalidation
 
 bcrypt = Bcrypt()
 csrf_protect = CSRFProtect()
@@ -24,6 +26,11 @@ bootstrap = Bootstrap5()
 babel = Babel()
 
 
+def pending_invalidation(session):
+    """cache keys the session's flushes cleared, deleted once it commits"""
+    return session.info.setdefault("mc_pending", PendingInvalidation())
+
+
 @babel.localeselector
 def get_locale():
     if request.args.get("lang"):
@@ -77,25 +84,31 @@ class BaseModel(PropsMixin, Model):
     def __flush_event__(cls, target):
         pass
 
+    # cache invalidations of the hooks below wait for the commit, so nothing
+    # is re-cached from data a concurrent reader can not see yet
     @staticmethod
     def _flush_insert_event(mapper, connection, target):
-        target._flush_event(mapper, connection, target)
-        target.__flush_insert_event__(target)
+        with deferred_invalidation(pending_invalidation(object_session(target))):
+            target._flush_event(mapper, connection, target)
+            target.__flush_insert_event__(target)
 
     @staticmethod
     def _flush_before_update_event(mapper, connection, target):
-        target._flush_event(mapper, connection, target)
-        target.__flush_before_update_event__(target)
+        with deferred_invalidation(pending_invalidation(object_session(target))):
+            target._flush_event(mapper, connection, target)
+            target.__flush_before_update_event__(target)
 
     @staticmethod
     def _flush_after_update_event(mapper, connection, target):
-        target._flush_event(mapper, connection, target)
-        target.__flush_after_update_event__(target)
+        with deferred_invalidation(pending_invalidation(object_session(target))):
+            target._flush_event(mapper, connection, target)
+            target.__flush_after_update_event__(target)
 
     @staticmethod
     def _flush_delete_event(mapper, connection, target):
-        target._flush_event(mapper, connection, target)
-        target.__flush_delete_event__(target)
+        with deferred_invalidation(pending_invalidation(object_session(target))):
+            target._flush_event(mapper, connection, target)
+            target.__flush_delete_event__(target)
 
     @classmethod
     def __flush_insert_event__(cls, target):
@@ -157,3 +170,15 @@ class UnLockedAlchemy(SQLAlchemy):
 
 
 db = UnLockedAlchemy(model_class=BaseModel)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_after_commit(session):
+    pending_invalidation(session).execute()
+
+
+@event.listens_for(db.session, "after_transaction_end")
+def _discard_invalidation(session, transaction):
+    # a rolled back transaction changed nothing, forget what it would clear
+    if transaction.parent is None:
+        pending_invalidation(session).clear()
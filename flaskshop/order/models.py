@@ -11,6 +11,7 @@ from flaskshop.constant import (
     PaymentStatusKinds,
     ShipStatusKinds,
 )
+from flaskshop.corelib.loader import batch, batched
 from flaskshop.database import Column, Model, db
 from flaskshop.discount.models import Voucher
 from flaskshop.product.models import ProductVariant
@@ -18,6 +19,10 @@ from flaskshop.product.models import ProductVariant
 # from sqlalchemy.dialects.mysql import TINYINT
 
 
+def _load_variants(lines):
+    return batch(ProductVariant.get_multi([line.variant_id for line in lines]))
+
+
 class Order(Model):
     __tablename__ = "order_order"
     token = Column(db.String(100), unique=True)
@@ -43,7 +48,7 @@ class Order(Model):
         to_update_orderlines = []
         total_net = 0
         for line in cart.lines:
-            variant = ProductVariant.get_by_id(line.variant.id)
+            variant = line.variant
             result, msg = variant.check_enough_stock(line.quantity)
             if result is False:
                 return result, msg
@@ -168,7 +173,7 @@ class Order(Model):
 
     @property
     def lines(self):
-        return OrderLine.query.filter(OrderLine.order_id == self.id).all()
+        return batch(OrderLine.query.filter(OrderLine.order_id == self.id).all())
 
     @property
     def notes(self):
@@ -263,6 +268,7 @@ class OrderLine(Model):
     product_id = Column(db.Integer())
 
     @property
+    @batched(_load_variants)
     def variant(self):
         return ProductVariant.get_by_id(self.variant_id)
 
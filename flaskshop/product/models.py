@@ -1,24 +1,299 @@
 import itertools
+import threading
+from collections import defaultdict
 
-from flask import current_app, request, url_for
-from sqlalchemy import desc, and_
+from flask import current_app, g, has_request_context, request, url_for
+from redis.exceptions import RedisError
+from sqlalchemy import Index, bindparam, desc, distinct, and_, delete, event, func, inspect, literal
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.sql import exists, select
+from sqlalchemy.orm import Session, aliased, object_session
+from sqlalchemy.sql import exists, select, update
 
 from flaskshop.corelib.db import PropsItem
-from flaskshop.corelib.mc import cache, cache_by_args, rdb
-from flaskshop.database import Column, Model, db
+from flaskshop.corelib.loader import batch, batched
+from flaskshop.corelib.mc import (
+    breaker,
+    bump_namespace,
+    cache,
+    cache_by_args,
+    deferred_invalidation,
+    get_namespace_version,
+    invalidate,
+)
+from flaskshop.corelib.paginator import encode_cursor, keyset_paginate, parse_cursor
+from flaskshop.corelib.utils import config_value
+from flaskshop.database import (
+    MC_KEY_GET_BY_ID,
+    Column,
+    Model,
+    db,
+    identity_map,
+    is_record_id,
+    title_key,
+)
+from flaskshop.extensions import pending_invalidation
 from flaskshop.settings import Config
 
 MC_KEY_FEATURED_PRODUCTS = "product:featured:{}"
 MC_KEY_PRODUCT_IMAGES = "product:product:{}:images"
 MC_KEY_PRODUCT_VARIANT = "product:product:{}:variant"
-MC_KEY_PRODUCT_DISCOUNT_PRICE = "product:product:{}:discount_price"
-MC_KEY_ATTRIBUTE_VALUES = "product:attribute:values:{}"
 MC_KEY_COLLECTION_PRODUCTS = "product:collection:{}:products:{}"
 MC_KEY_ARTIST_PRODUCTS = "product:artist:{}:products:{}"
 MC_KEY_ARTIST_CHILDREN = "product:artist:{}:children"
+MC_KEY_ARTIST_SUBTREE = "product:artist:{}:subtree"
+MC_KEY_ARTIST_FACETS = "product:artist:{}:facets"
+MC_KEY_ALL_ARTISTS = "product:artists:{}"
+MC_KEY_COLLECTION_FACETS = "product:collection:{}:facets"
+
+# sort_by arg of the listings -> the Product column they are ordered by
+PRODUCT_SORT_COLUMNS = {"title": "title", "basic_price": "effective_price"}
+
+MC_NS_FEATURED_PRODUCTS = "product:featured"
+MC_NS_COLLECTION_PRODUCTS = "product:collection:{}:products"
+MC_NS_ARTIST_PRODUCTS = "product:artist:{}:products"
+MC_NS_CATALOG = "product:catalog"
+MC_NS_ALL_ARTISTS = "product:artists"
+MC_NS_ARTIST_TREE = "product:artist:tree"
+
+
+def product_list_args():
+    """request args read by get_product_list_context, with their types,
+    attribute filters are passed by attribute title. An explicit page number
+    is kept, so offset and cursor pages of a listing have distinct keys."""
+    args = {
+        "price_from": int,
+        "price_to": int,
+        "sort_by": sort_by_arg,
+        "page": int,
+        "cursor": cursor_arg,
+    }
+    args.update((title, int) for title in ProductAttribute.get_titles())
+    return args
+
+
+def sort_by_arg(value):
+    """a sort_by arg the listings know, e.g. "-basic_price"; raises
+    ValueError for any other"""
+    field = value[1:] if value.startswith("-") else value
+    if field not in PRODUCT_SORT_COLUMNS:
+        raise ValueError(value)
+    return value
+
+
+def cursor_arg(value):
+    """the cursor arg re-encoded, so one position has one cache key; raises
+    ValueError for a cursor that does not fit the order of the request or
+    is not used by it, such a request is served and cached as the first page"""
+    if not keyset_requested():
+        raise ValueError(value)
+    sort_by = request.args.get("sort_by", "", type=sort_by_arg)
+    columns = product_sort_columns(sort_by.lstrip("-"))
+    backwards, values = parse_cursor(value, columns)
+    return encode_cursor(values, backwards)
+
+
+def keyset_requested():
+    """whether the request pages by cursor, ?page=N keeps offset pages"""
+    return (
+        config_value("KEYSET_PAGINATION")
+        and request.args.get("page", type=int) is None
+    )
+
+
+def product_facets(query):
+    """the product type ids and the product count of every (attribute id,
+    value id) among the products of query, aggregated by the database over
+    product_attribute_index"""
+    type_ids = query.with_entities(Product.product_type_id).distinct()
+    index = product_attribute_index.c
+    counts = (
+        query.join(product_attribute_index, index.product_id == Product.id)
+        .with_entities(
+            index.attribute_id, index.value_id, func.count(distinct(index.product_id))
+        )
+        .group_by(index.attribute_id, index.value_id)
+    )
+    return {
+        "type_ids": sorted(type_id for type_id, in type_ids if type_id),
+        "counts": {(attr_id, value_id): n for attr_id, value_id, n in counts},
+    }
+
+
+def facet_attributes(type_ids, excluded_names, order_of_names):
+    """the attributes of the product types to filter by, in display order"""
+    type_attributes = get_catalog().type_attributes
+    attr_filter = {
+        attr
+        for type_id in type_ids
+        for attr in type_attributes.get(type_id, [])
+        if attr.title not in excluded_names
+    }
+
+    def get_sort_index(attr):
+        index = order_of_names.index(attr.title) if attr.title in order_of_names else len(order_of_names)
+        return index, attr.id
+
+    return sorted(attr_filter, key=get_sort_index)
+
+
+def _load_images(products):
+    images = defaultdict(list)
+    query = ProductImage.query.filter(
+        ProductImage.product_id.in_({p.id for p in products})
+    ).order_by(ProductImage.id)
+    for image in query:
+        images[image.product_id].append(image)
+    return [images[p.id] for p in products]
+
+
+def _load_first_images(products):
+    # the lowest image id of every product, in one grouped query
+    first_ids = (
+        select(func.min(ProductImage.id))
+        .where(ProductImage.product_id.in_({p.id for p in products}))
+        .group_by(ProductImage.product_id)
+    )
+    images = ProductImage.query.with_entities(
+        ProductImage.product_id, ProductImage.image
+    ).filter(ProductImage.id.in_(first_ids))
+    paths = dict(images.all())
+    return [paths.get(p.id, "") for p in products]
+
+
+def _load_artists(products):
+    return batch(Artist.get_multi([p.artist_id for p in products]))
+
+
+def _load_variant_products(variants):
+    return batch(Product.get_multi([v.product_id for v in variants]))
+
+
+# one row per attribute value of a product, so filtering by a value is an
+# indexed lookup instead of a scan of the attributes json of every product
+product_attribute_index = db.Table(
+    "product_attribute_index",
+    Column("product_id", db.Integer(), primary_key=True),
+    Column("attribute_id", db.Integer(), primary_key=True),
+    Column("value_id", db.Integer(), nullable=False),
+    Index("ix_product_attribute_index_value", "attribute_id", "value_id", "product_id"),
+    mysql_charset="utf8mb4",
+)
+
+
+def index_attributes(session, product_ids):
+    """rewrite the product_attribute_index rows of product_ids from their
+    attributes, products that are gone lose their rows"""
+    connection = session.connection()
+    connection.execute(
+        delete(product_attribute_index).where(
+            product_attribute_index.c.product_id.in_(product_ids)
+        )
+    )
+    rows = connection.execute(
+        select(Product.id, Product.attributes).where(Product.id.in_(product_ids))
+    )
+    values = [
+        {"product_id": id, "attribute_id": int(attr_id), "value_id": int(value_id)}
+        for id, attributes in rows
+        for attr_id, value_id in (attributes or {}).items()
+        if is_record_id(attr_id) and is_record_id(value_id)
+    ]
+    if values:
+        connection.execute(product_attribute_index.insert(), values)
+    # filtered listings and their facets were computed from the old rows
+    listings_changed(session, product_ids)
+
+
+def index_attributes_later(target):
+    """index the attributes of target once the flush is done"""
+    object_session(target).info.setdefault("attribute_index", set()).add(target.id)
+
+
+@event.listens_for(db.session, "after_flush_postexec")
+def _index_attributes_after_flush(session, flush_context):
+    product_ids = session.info.pop("attribute_index", None)
+    if product_ids:
+        index_attributes(session, product_ids)
+
+
+def products_changed(session, product_ids, names):
+    """expire the columns names of product_ids rewritten by a Core UPDATE,
+    their cached copies and listings are dropped when the session commits"""
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Product) and obj.id in product_ids:
+            session.expire(obj, names)
+    memo = identity_map()
+    if memo:
+        for key in [key for key in memo if key[1] is Product]:
+            del memo[key]
+    with deferred_invalidation(pending_invalidation(session)):
+        for id in product_ids:
+            invalidate(MC_KEY_GET_BY_ID.format(Product.__name__, id))
+    listings_changed(session, product_ids)
+
+
+def listings_changed(session, product_ids):
+    """the cached artist, collection and featured listings of product_ids are
+    dropped when the session commits"""
+    connection = session.connection()
+    artist_ids = connection.execute(
+        select(Product.artist_id).where(Product.id.in_(product_ids)).distinct()
+    ).scalars().all()
+    # the pages of the ancestors list the products too
+    paths = connection.execute(
+        select(Artist.id, Artist.path).where(Artist.id.in_(artist_ids))
+    ).all()
+    artist_ids = set(artist_ids)
+    for _, path in paths:
+        artist_ids.update(int(id) for id in (path or "").split("/") if id)
+    collection_ids = connection.execute(
+        select(ProductCollection.collection_id)
+        .where(ProductCollection.product_id.in_(product_ids))
+        .distinct()
+    ).scalars().all()
+    with deferred_invalidation(pending_invalidation(session)):
+        for artist_id in artist_ids:
+            if artist_id is not None:
+                bump_namespace(MC_NS_ARTIST_PRODUCTS.format(artist_id))
+        for collection_id in collection_ids:
+            bump_namespace(MC_NS_COLLECTION_PRODUCTS.format(collection_id))
+        bump_namespace(MC_NS_FEATURED_PRODUCTS)
+
+
+def update_primary_images(session, product_ids):
+    """set primary_image of product_ids to the path of their first image,
+    "" for products without images"""
+    product = Product.__table__
+    first = (
+        select(ProductImage.image)
+        .where(ProductImage.product_id == product.c.id)
+        .order_by(ProductImage.id)
+        .limit(1)
+        .correlate(product)
+        .scalar_subquery()
+    )
+    session.connection().execute(
+        update(product)
+        .where(product.c.id.in_(product_ids))
+        .values(primary_image=func.coalesce(first, ""))
+    )
+    products_changed(session, product_ids, ["primary_image"])
+
+
+def update_primary_images_later(target):
+    """update the primary image of the product of target once the flush is done"""
+    if target.product_id is not None:
+        object_session(target).info.setdefault("primary_image", set()).add(
+            target.product_id
+        )
+
+
+@event.listens_for(db.session, "after_flush_postexec")
+def _update_primary_images_after_flush(session, flush_context):
+    product_ids = session.info.pop("primary_image", None)
+    if product_ids:
+        update_primary_images(session, product_ids)
 
 
 class Product(Model):
@@ -31,7 +306,15 @@ class Product(Model):
     sold_count = Column(db.Integer(), default=0)
     review_count = Column(db.Integer(), default=0)
     basic_price = Column(db.DECIMAL(10, 2))
-    artist_id = Column(db.Integer())
+    # kept up to date by flaskshop.discount.models.reprice
+    discount_amount = Column(db.DECIMAL(10, 2), default=0)
+    effective_price = Column(db.DECIMAL(10, 2), index=True)
+    artist_id = Column(db.Integer(), index=True)
+    # path of the first image, kept by update_primary_images so listings
+    # need no image query; "" without images, which a new product starts
+    # with. Rows older than the column are NULL until build-primary-images
+    # backfills them, first_img looks those up.
+    primary_image = Column(db.String(255), default="")
     is_featured = Column(db.Boolean(), default=False)
     product_type_id = Column(db.Integer())
     attributes = Column(MutableDict.as_mutable(db.JSON()))
@@ -49,14 +332,29 @@ class Product(Model):
         return url_for("product.show", id=self.id)
 
     @property
+    @batched(_load_images)
     @cache(MC_KEY_PRODUCT_IMAGES.format("{self.id}"))
     def images(self):
         return ProductImage.query.filter(ProductImage.product_id == self.id).all()
 
+    @property
+    @batched(_load_first_images)
+    def first_image(self):
+        image = (
+            ProductImage.query.filter(ProductImage.product_id == self.id)
+            .order_by(ProductImage.id)
+            .first()
+        )
+        return image.image if image else ""
+
     @property
     def first_img(self):
-        if self.images:
-            return str(self.images[0])
+        # NULL is not backfilled yet, "" has no images
+        path = self.primary_image
+        if path is None:
+            path = self.first_image
+        if path:
+            return url_for("static", filename=path, _external=True)
         return ""
 
     @ property
@@ -72,12 +370,14 @@ class Product(Model):
         return self.quantity - self.quantity_allocated
 
     @property
+    @batched(_load_artists)
     def artist(self):
         return Artist.get_by_id(self.artist_id)
 
     @property
     def product_type(self):
-        return ProductType.get_by_id(self.product_type_id)
+        """the shared ProductType of the catalog snapshot, read only"""
+        return get_catalog().types.get(self.product_type_id)
 
     @property
     def is_discounted(self):
@@ -86,16 +386,14 @@ class Product(Model):
         return False
 
     @property
-    @cache(MC_KEY_PRODUCT_DISCOUNT_PRICE.format("{self.id}"))
     def discounted_price(self):
-        from flaskshop.discount.models import Sale
-
-        return Sale.get_discounted_price(self)
+        return self.discount_amount or 0
 
     @property
     def price(self):
-        if self.is_discounted:
-            return self.basic_price - self.discounted_price
+        if self.effective_price is not None:
+            return self.effective_price
+        # not repriced yet
         return self.basic_price
 
     @property
@@ -111,37 +409,40 @@ class Product(Model):
     def variant(self):
         return ProductVariant.query.filter(ProductVariant.product_id == self.id).all()
 
+    @property
+    def variant_tree(self):
+        if not hasattr(self, "_variant_tree"):
+            self._variant_tree = VariantTree(self.variant)
+        return self._variant_tree
+
     @property
     def variant_first_level(self):
-        first_level_variant_ids = [
-            variant.id for variant in ProductVariant.first_level_items(self.id)]
-        return ProductVariant.query.filter(ProductVariant.id.in_(first_level_variant_ids)).all()
+        return self.variant_tree.first_level
 
     @property
     def variant_children(self):
-        return [child for vari in self.variant for child in vari.middle_children]
+        return self.variant_tree.middle_level
 
     @property
     def all_last_children(self):
-        all_children = []
-        for variant in self.variant:
-            all_children.extend(variant.last_children)
-        return all_children
+        return self.variant_tree.last_level
 
     @property
     def attribute_map(self):
+        catalog = get_catalog()
         items = {
-            ProductAttribute.get_by_id(k): AttributeChoiceValue.get_by_id(v)
+            catalog.attribute(k): catalog.value(v)
             for k, v in self.attributes.items()
         }
         return items
 
     @property
     def title_map_for_attributes(self):
+        catalog = get_catalog()
         title_map = {}
         for k, v in self.attributes.items():
-            product_attribute = ProductAttribute.get_by_id(k)
-            attribute_choice_value = AttributeChoiceValue.get_by_id(v)
+            product_attribute = catalog.attribute(k)
+            attribute_choice_value = catalog.value(v)
 
             if product_attribute is not None and attribute_choice_value is not None:
                 title_map[product_attribute.title] = attribute_choice_value.title
@@ -153,7 +454,12 @@ class Product(Model):
         return True, "success"
 
     @classmethod
-    @cache(MC_KEY_FEATURED_PRODUCTS.format("{num}"))
+    @cache(
+        MC_KEY_FEATURED_PRODUCTS.format("{num}"),
+        namespace=MC_NS_FEATURED_PRODUCTS,
+        single_flight=True,
+        xfetch=1.0,
+    )
     def get_featured_product(cls, num=8):
         return cls.query.filter_by(is_featured=True).limit(num).all()
 
@@ -207,21 +513,41 @@ class Product(Model):
 
     @staticmethod
     def clear_mc(target):
-        rdb.delete(MC_KEY_PRODUCT_DISCOUNT_PRICE.format(target.id))
-        keys = rdb.keys(MC_KEY_FEATURED_PRODUCTS.format("*"))
-        for key in keys:
-            rdb.delete(key)
+        bump_namespace(MC_NS_FEATURED_PRODUCTS)
 
     @staticmethod
     def clear_artist_cache(target):
-        keys = rdb.keys(MC_KEY_ARTIST_PRODUCTS.format(
-            target.artist_id, "*"))
-        for key in keys:
-            rdb.delete(key)
+        # the pages of the ancestors list the product too, and those of the
+        # artist it moved away from listed it until now
+        moved_from = inspect(target).attrs.artist_id.history.deleted or ()
+        for id in {target.artist_id, *moved_from}:
+            artist = Artist.get_by_id(id)
+            for artist_id in artist.ancestor_ids if artist else [id]:
+                bump_namespace(MC_NS_ARTIST_PRODUCTS.format(artist_id))
+
+    @staticmethod
+    def clear_collection_cache(target):
+        # only facet changes, stock and sales counters change far more often
+        state = inspect(target)
+        if not any(
+            state.attrs[name].history.has_changes()
+            for name in ("attributes", "product_type_id")
+        ):
+            return
+        query = ProductCollection.query.with_entities(
+            ProductCollection.collection_id
+        ).filter_by(product_id=target.id)
+        for collection_id, in query:
+            bump_namespace(MC_NS_COLLECTION_PRODUCTS.format(collection_id))
 
     @classmethod
     def __flush_insert_event__(cls, target):
+        from flaskshop.discount.models import reprice_later
+
         super().__flush_insert_event__(target)
+        reprice_later(target, product=target.id)
+        index_attributes_later(target)
+        bump_namespace(MC_NS_ALL_ARTISTS)
 
         if current_app.config["USE_ES"]:
             from flaskshop.public.search import Item
@@ -230,9 +556,18 @@ class Product(Model):
 
     @classmethod
     def __flush_before_update_event__(cls, target):
+        from flaskshop.discount.models import reprice_later
 
         super().__flush_before_update_event__(target)
         target.clear_artist_cache(target)
+        state = inspect(target)
+        if any(
+            state.attrs[name].history.has_changes()
+            for name in ("basic_price", "artist_id")
+        ):
+            reprice_later(target, product=target.id)
+        if state.attrs.artist_id.history.has_changes():
+            bump_namespace(MC_NS_ALL_ARTISTS)
 
     @classmethod
     def __flush_after_update_event__(cls, target):
@@ -240,6 +575,9 @@ class Product(Model):
         super().__flush_after_update_event__(target)
         target.clear_mc(target)
         target.clear_artist_cache(target)
+        target.clear_collection_cache(target)
+        if inspect(target).attrs.attributes.history.has_changes():
+            index_attributes_later(target)
         if current_app.config["USE_ES"]:
             from flaskshop.public.search import Item
 
@@ -251,6 +589,8 @@ class Product(Model):
         super().__flush_delete_event__(target)
         target.clear_mc(target)
         target.clear_artist_cache(target)
+        index_attributes_later(target)
+        bump_namespace(MC_NS_ALL_ARTISTS)
 
         if current_app.config["USE_ES"]:
             from flaskshop.public.search import Item
@@ -264,6 +604,9 @@ class Artist(Model):
     parent_id = Column(db.Integer(), default=0)
     background_img = Column(db.String(255))
     biography = Column(db.Text())
+    # ids from the root down to the artist, e.g. "/1/4/9/", kept by
+    # update_artist_paths, so a subtree is one indexed prefix match
+    path = Column(db.String(255), index=True)
 
     def __str__(self):
         return self.title
@@ -271,17 +614,35 @@ class Artist(Model):
     def get_absolute_url(self):
         return url_for("product.show_artist", id=self.id)
 
+    @property
+    def ancestor_ids(self):
+        """ids from the root down to the artist itself"""
+        if not self.path:
+            return [id for id in (self.parent_id, self.id) if id]
+        return [int(id) for id in self.path.strip("/").split("/")]
+
+    @property
+    @cache(MC_KEY_ARTIST_SUBTREE.format("{self.id}"), namespace=MC_NS_ARTIST_TREE)
+    def subtree_ids(self):
+        """ids of the artist and of all its descendants"""
+        if not self.path:
+            # paths not built yet, direct children only
+            return [child.id for child in self.children] + [self.id]
+        query = Artist.query.with_entities(Artist.id).filter(
+            Artist.path.startswith(self.path)
+        )
+        return [id for id, in query]
+
     @property
     def background_img_url(self):
         return url_for("static", filename=self.background_img)
 
     @property
     def products(self):
-        all_artist_ids = [child.id for child in self.children] + [self.id]
-        return Product.query.filter(Product.artist_id.in_(all_artist_ids)).all()
+        return Product.query.filter(Product.artist_id.in_(self.subtree_ids)).all()
 
     @property
-    @cache(MC_KEY_ARTIST_CHILDREN.format("{self.id}"))
+    @cache(MC_KEY_ARTIST_CHILDREN.format("{self.id}"), namespace=MC_NS_ARTIST_TREE)
     def children(self):
         return Artist.query.filter(Artist.parent_id == self.id).all()
 
@@ -290,67 +651,72 @@ class Artist(Model):
         return Artist.get_by_id(self.parent_id)
 
     @property
-    def attr_filter(self):
-        attr_filter = set()
-        for product in self.products:
-            for attr in product.product_type.product_attributes:
-                if attr.title not in ["Size", "Year", "Reference", "Publisher", "Artist"]:
-                    attr_filter.add(attr)
-        order_of_names = ["Technique", "Signature", "Period"]
-
-        def get_sort_index(attr):
-            return order_of_names.index(attr.title) if attr.title in order_of_names else len(order_of_names)
+    @cache(
+        MC_KEY_ARTIST_FACETS.format("{self.id}"),
+        namespace=MC_NS_ARTIST_PRODUCTS.format("{self.id}"),
+    )
+    def facets(self):
+        return product_facets(
+            Product.query.filter(Product.artist_id.in_(self.subtree_ids))
+        )
 
-        sorted_attr_filter = sorted(attr_filter, key=get_sort_index)
-        return sorted_attr_filter
+    @property
+    def attr_filter(self):
+        return facet_attributes(
+            self.facets["type_ids"],
+            ["Size", "Year", "Reference", "Publisher", "Artist"],
+            ["Technique", "Signature", "Period"],
+        )
 
     @classmethod
-    @cache_by_args(MC_KEY_ARTIST_PRODUCTS.format("{artist_id}", "{page}"))
+    @cache_by_args(
+        MC_KEY_ARTIST_PRODUCTS.format("{artist_id}", "{page}"),
+        namespace=MC_NS_ARTIST_PRODUCTS.format("{artist_id}"),
+        single_flight=True,
+        xfetch=1.0,
+        query_args=product_list_args,
+    )
     def get_product_by_artist(cls, artist_id, page):
         artist = Artist.get_by_id(artist_id)
-        all_artist_ids = [
-            child.id for child in artist.children] + [artist.id]
-        query = Product.query.filter(Product.artist_id.in_(all_artist_ids))
+        query = Product.query.filter(Product.artist_id.in_(artist.subtree_ids))
         ctx, query = get_product_list_context(query, artist)
-        pagination = query.paginate(page, per_page=16)
-        del pagination.query
+        pagination = paginate_products(query, ctx, page)
         ctx.update(object=artist, pagination=pagination,
                    products=pagination.items)
         return ctx
 
     @classmethod
-    @cache_by_args(MC_KEY_ARTIST_PRODUCTS.format("{title}", "{page}"))
     def get_product_by_artist_title(cls, title, page):
+        # share the id keyed cache, so the artist namespace invalidates it too
         artist = Artist.get_by_title(title)
-        all_artist_ids = [
-            child.id for child in artist.children] + [artist.id]
-        query = Product.query.filter(Product.artist_id.in_(all_artist_ids))
-        ctx, query = get_product_list_context(query, artist)
-        pagination = query.paginate(page, per_page=16)
-        del pagination.query
-        ctx.update(object=artist, pagination=pagination,
-                   products=pagination.items)
-        return ctx
+        return cls.get_product_by_artist(artist.id, page)
 
     @classmethod
-    @cache_by_args(MC_KEY_ARTIST_PRODUCTS.format("{artist_id}", "{page}"))
-    def get_all_artists(cls):
-        artists = Artist.query.all()
-        artists_with_product_count = []
-
-        for artist in artists:
-            product_count = Product.query.filter(
-                Product.artist_id == artist.id).count()
-            artists_with_product_count.append((artist, product_count))
-
-        ctx = {}
-        # ctx, query = get_product_list_context(query, artist)
-        # pagination = query.paginate(page, per_page=16)
-        # del pagination.query
-        # ctx.update(artists=artists, pagination=pagination,
-        #            products=pagination.items)
-        ctx.update(artists_with_product_count=artists_with_product_count)
-        return ctx
+    @cache(
+        MC_KEY_ALL_ARTISTS.format("{page}"),
+        namespace=MC_NS_ALL_ARTISTS,
+        single_flight=True,
+    )
+    def get_all_artists(cls, page=1):
+        """artists with the product count of their whole subtree, as listed
+        on their page, from one grouped count for the artists of the page"""
+        pagination = cls.query.order_by(cls.title, cls.id).paginate(page, per_page=24)
+        del pagination.query
+        member = aliased(cls)
+        counts = dict(
+            db.session.query(cls.id, func.count(Product.id))
+            .join(member, member.path.startswith(cls.path) | (member.id == cls.id))
+            .join(Product, Product.artist_id == member.id)
+            .filter(cls.id.in_([artist.id for artist in pagination.items]))
+            .group_by(cls.id)
+        )
+        pagination.items = [
+            (artist, counts.get(artist.id, 0)) for artist in pagination.items
+        ]
+        return {
+            "pagination": pagination,
+            "artists_with_product_count": pagination.items,
+        }
 
     @classmethod
     def first_level_items(cls):
@@ -374,10 +740,22 @@ class Artist(Model):
 
     @staticmethod
     def clear_mc(target):
-        rdb.delete(MC_KEY_ARTIST_CHILDREN.format(target.id))
-        keys = rdb.keys(MC_KEY_ARTIST_PRODUCTS.format(target.id, "*"))
-        for key in keys:
-            rdb.delete(key)
+        # children and subtree_ids of its ancestors may list it
+        bump_namespace(MC_NS_ARTIST_TREE)
+        bump_namespace(MC_NS_ARTIST_PRODUCTS.format(target.id))
+        bump_namespace(MC_NS_ALL_ARTISTS)
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        super().__flush_insert_event__(target)
+        bump_namespace(MC_NS_ALL_ARTISTS)
+        update_artist_paths_later(target)
+
+    @classmethod
+    def __flush_before_update_event__(cls, target):
+        super().__flush_before_update_event__(target)
+        if inspect(target).attrs.parent_id.history.has_changes():
+            update_artist_paths_later(target)
 
     @classmethod
     def __flush_after_update_event__(cls, target):
@@ -390,6 +768,113 @@ class Artist(Model):
         target.clear_mc(target)
 
 
+def update_artist_paths(session, artist_ids):
+    """recompute the path of artist_ids after their parent changed, moving
+    their whole subtree with one UPDATE per artist"""
+    connection = session.connection()
+    moved = set()
+    # parents inserted by the same flush have smaller ids and come first
+    for id in sorted(artist_ids):
+        row = connection.execute(
+            select(Artist.parent_id, Artist.path).where(Artist.id == id)
+        ).first()
+        if row is None:
+            continue
+        parent_id, old_path = row
+        parent_path = None
+        if parent_id:
+            parent_path = connection.execute(
+                select(Artist.path).where(Artist.id == parent_id)
+            ).scalar()
+        if old_path and parent_path and parent_path.startswith(old_path):
+            raise ValueError(f"artist {id} can not move under its own subtree")
+        new_path = f"{parent_path or '/'}{id}/"
+        if new_path == old_path:
+            continue
+        if old_path:
+            subtree = Artist.path.startswith(old_path)
+            path = literal(new_path) + func.substr(Artist.path, len(old_path) + 1)
+        else:
+            subtree = Artist.id == id
+            path = new_path
+        moved.update(connection.execute(select(Artist.id).where(subtree)).scalars())
+        connection.execute(update(Artist.__table__).where(subtree).values(path=path))
+        # the pages of the old and new ancestors list other products now
+        for path_ in (old_path, new_path):
+            for ancestor_id in (path_ or "").strip("/").split("/"):
+                if ancestor_id:
+                    bump_namespace(MC_NS_ARTIST_PRODUCTS.format(ancestor_id))
+
+    artist_paths_changed(session, moved)
+
+
+def artist_paths_changed(session, artist_ids):
+    """expire the rewritten paths of artist_ids, their cached copies and the
+    hierarchy caches are dropped when the session commits"""
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Artist) and obj.id in artist_ids:
+            session.expire(obj, ["path"])
+    memo = identity_map()
+    if memo:
+        for key in [key for key in memo if key[1] is Artist]:
+            del memo[key]
+    titles = session.connection().execute(
+        select(Artist.id, Artist.title).where(Artist.id.in_(artist_ids))
+    )
+    with deferred_invalidation(pending_invalidation(session)):
+        for id, title in titles:
+            invalidate(
+                MC_KEY_GET_BY_ID.format(Artist.__name__, id),
+                title_key(Artist, title),
+            )
+        bump_namespace(MC_NS_ARTIST_TREE)
+        bump_namespace(MC_NS_ALL_ARTISTS)
+
+
+def rebuild_artist_paths(session):
+    """compute the path of every artist from the parent ids, returns how
+    many artists there are"""
+    rows = session.execute(select(Artist.id, Artist.parent_id, Artist.path)).all()
+    parents = {id: parent_id for id, parent_id, _ in rows}
+    paths = {}
+
+    def path_of(id):
+        chain = []
+        while id and id in parents and id not in paths and id not in chain:
+            chain.append(id)
+            id = parents[id]
+        path = paths.get(id, "/")
+        for id in reversed(chain):
+            path = paths[id] = f"{path}{id}/"
+        return path
+
+    for id in parents:
+        path_of(id)
+    changed = {id for id, _, path in rows if id in paths and paths[id] != path}
+    if changed:
+        session.execute(
+            update(Artist.__table__)
+            .where(Artist.__table__.c.id == bindparam("artist_id"))
+            .values(path=bindparam("artist_path")),
+            [{"artist_id": id, "artist_path": paths[id]} for id in changed],
+        )
+        artist_paths_changed(session, changed)
+    return len(paths)
+
+
+def update_artist_paths_later(target):
+    """update the path of target once the flush is done"""
+    object_session(target).info.setdefault("artist_paths", set()).add(target.id)
+
+
+@event.listens_for(db.session, "after_flush_postexec")
+def _update_artist_paths_after_flush(session, flush_context):
+    artist_ids = session.info.pop("artist_paths", None)
+    if artist_ids:
+        with deferred_invalidation(pending_invalidation(session)):
+            update_artist_paths(session, artist_ids)
+
+
 class ProductTypeAttributes(Model):
     """存储的产品的属性是包括用户可选和不可选"""
     """The attributes of the stored product include user-selectable and non-selectable"""
@@ -398,6 +883,11 @@ class ProductTypeAttributes(Model):
     product_type_id = Column(db.Integer())
     product_attribute_id = Column(db.Integer())
 
+    @classmethod
+    def __flush_event__(cls, target):
+        super().__flush_event__(target)
+        catalog_changed(target)
+
 
 class ProductTypeVariantAttributes(Model):
     """存储的产品SKU的属性是可以给用户去选择的"""
@@ -407,6 +897,11 @@ class ProductTypeVariantAttributes(Model):
     product_type_id = Column(db.Integer())
     product_attribute_id = Column(db.Integer())
 
+    @classmethod
+    def __flush_event__(cls, target):
+        super().__flush_event__(target)
+        catalog_changed(target)
+
 
 class ProductType(Model):
     __tablename__ = "product_type"
@@ -419,33 +914,15 @@ class ProductType(Model):
 
     @property
     def product_attributes_ids(self):
-        at_ids = (
-            ProductTypeAttributes.query.with_entities(
-                ProductTypeAttributes.product_attribute_id
-            )
-            .filter(ProductTypeAttributes.product_type_id == self.id)
-            .all()
-        )
-        return [id[0] for id in at_ids]
+        return [attr.id for attr in self.product_attributes]
 
     @property
     def product_attributes(self):
-        return ProductAttribute.query.filter(
-            ProductAttribute.id.in_(self.product_attributes_ids)
-        ).all()
+        return get_catalog().type_attributes.get(self.id, [])
 
     @property
     def variant_attributes(self):
-        at_ids = (
-            ProductTypeVariantAttributes.query.with_entities(
-                ProductTypeVariantAttributes.product_attribute_id
-            )
-            .filter(ProductTypeVariantAttributes.product_type_id == self.id)
-            .all()
-        )
-        return ProductAttribute.query.filter(
-            ProductAttribute.id.in_(id for id, in at_ids)
-        ).all()
+        return get_catalog().type_variant_attributes.get(self.id, [])
 
     @property
     def variant_attr_id(self):
@@ -507,6 +984,11 @@ class ProductType(Model):
         db.session.delete(self)
         db.session.commit()
 
+    @classmethod
+    def __flush_event__(cls, target):
+        super().__flush_event__(target)
+        catalog_changed(target)
+
 
 class ProductVariant(Model):
     __tablename__ = "product_variant"
@@ -537,23 +1019,15 @@ class ProductVariant(Model):
 
     @property
     def children(self):
-        return ProductVariant.query.filter(ProductVariant.parent_id == self.id).all()
+        return self.product.variant_tree.children(self)
 
     @property
     def middle_children(self):
-
-        return ProductVariant.query.filter(
-            and_(ProductVariant.parent_id == self.id,
-                 ProductVariant.id.in_(ProductVariant.query.with_entities(ProductVariant.parent_id)))
-        ).all()
+        return self.product.variant_tree.middle_children(self)
 
     @property
     def last_children(self):
-
-        return ProductVariant.query.filter(
-            and_(ProductVariant.parent_id == self.id,
-                 ~ProductVariant.id.in_(ProductVariant.query.with_entities(ProductVariant.parent_id)))
-        ).all()
+        return self.product.variant_tree.last_children(self)
 
     @ property
     def is_shipping_required(self):
@@ -564,6 +1038,7 @@ class ProductVariant(Model):
         return self.price_override or self.product.price
 
     @ property
+    @ batched(_load_variant_products)
     def product(self):
         return Product.get_by_id(self.product_id)
 
@@ -572,18 +1047,20 @@ class ProductVariant(Model):
 
     @ property
     def attribute_map(self):
+        catalog = get_catalog()
         items = {
-            ProductAttribute.get_by_id(k): AttributeChoiceValue.get_by_id(v)
+            catalog.attribute(k): catalog.value(v)
             for k, v in self.attributes.items()
         }
         return items
 
     @ property
     def title_map_for_attributes(self):
+        catalog = get_catalog()
         title_map = {}
         for k, v in self.attributes.items():
-            product_attribute = ProductAttribute.get_by_id(k)
-            attribute_choice_value = AttributeChoiceValue.get_by_id(v)
+            product_attribute = catalog.attribute(k)
+            attribute_choice_value = catalog.value(v)
 
             if product_attribute is not None and attribute_choice_value is not None:
                 title_map[product_attribute.title] = attribute_choice_value.title
@@ -591,7 +1068,7 @@ class ProductVariant(Model):
 
     @ staticmethod
     def clear_mc(target):
-        rdb.delete(MC_KEY_PRODUCT_VARIANT.format(target.product_id))
+        invalidate(MC_KEY_PRODUCT_VARIANT.format(target.product_id))
 
     @ classmethod
     def get_all_variants(cls):
@@ -633,6 +1110,40 @@ class ProductVariant(Model):
         target.clear_mc(target)
 
 
+class VariantTree:
+    """the parent/child levels of a product's variants, built in memory from
+    the product's variant list"""
+
+    def __init__(self, variants):
+        self.variants = variants
+        self._children = {}
+        for variant in variants:
+            self._children.setdefault(variant.parent_id, []).append(variant)
+
+    @property
+    def first_level(self):
+        return self._children.get(0, [])
+
+    def children(self, variant):
+        return self._children.get(variant.id, [])
+
+    def middle_children(self, variant):
+        """children having children of their own"""
+        return [c for c in self.children(variant) if c.id in self._children]
+
+    def last_children(self, variant):
+        """children without children"""
+        return [c for c in self.children(variant) if c.id not in self._children]
+
+    @property
+    def middle_level(self):
+        return [c for v in self.variants for c in self.middle_children(v)]
+
+    @property
+    def last_level(self):
+        return [c for v in self.variants for c in self.last_children(v)]
+
+
 class ProductAttribute(Model):
     __tablename__ = "product_attribute"
     title = Column(db.String(255), nullable=False)
@@ -641,8 +1152,15 @@ class ProductAttribute(Model):
         return self.title
 
     @ property
-    @ cache(MC_KEY_ATTRIBUTE_VALUES.format("{self.id}"))
     def values(self):
+        return get_catalog().attribute_values.get(self.id, [])
+
+    @ classmethod
+    def get_titles(cls):
+        return get_catalog().titles
+
+    def query_values(self):
+        """the values as instances of the session, for changing them"""
         return AttributeChoiceValue.query.filter(
             AttributeChoiceValue.attribute_id == self.id
         ).all()
@@ -673,10 +1191,11 @@ class ProductAttribute(Model):
         return ",".join([t.title for t in self.types])
 
     def update_values(self, new_values):
-        origin_values = list(value.title for value in self.values)
+        values = self.query_values()
+        origin_values = list(value.title for value in values)
         need_del = set()
         need_add = set()
-        for value in self.values:
+        for value in values:
             if value.title not in new_values:
                 need_del.add(value)
         for value in new_values:
@@ -720,21 +1239,16 @@ class ProductAttribute(Model):
             product_attribute_id=self.id
         ).all()
         for item in itertools.chain(
-            need_del_product_attrs, need_del_variant_attrs, self.values
+            need_del_product_attrs, need_del_variant_attrs, self.query_values()
         ):
             item.delete(commit=False)
         db.session.delete(self)
         db.session.commit()
 
     @ classmethod
-    def __flush_after_update_event__(cls, target):
-        super().__flush_after_update_event__(target)
-        rdb.delete(MC_KEY_ATTRIBUTE_VALUES.format(target.id))
-
-    @ classmethod
-    def __flush_delete_event__(cls, target):
-        super().__flush_delete_event__(target)
-        rdb.delete(MC_KEY_ATTRIBUTE_VALUES.format(target.id))
+    def __flush_event__(cls, target):
+        super().__flush_event__(target)
+        catalog_changed(target)
 
 
 class AttributeChoiceValue(Model):
@@ -747,7 +1261,12 @@ class AttributeChoiceValue(Model):
 
     @ property
     def attribute(self):
-        return ProductAttribute.get_by_id(self.attribute_id)
+        return get_catalog().attributes.get(self.attribute_id)
+
+    @ classmethod
+    def __flush_event__(cls, target):
+        super().__flush_event__(target)
+        catalog_changed(target)
 
 
 class ProductImage(Model):
@@ -760,17 +1279,19 @@ class ProductImage(Model):
 
     @ staticmethod
     def clear_mc(target):
-        rdb.delete(MC_KEY_PRODUCT_IMAGES.format(target.product_id))
+        invalidate(MC_KEY_PRODUCT_IMAGES.format(target.product_id))
 
     @ classmethod
     def __flush_insert_event__(cls, target):
         super().__flush_insert_event__(target)
         target.clear_mc(target)
+        update_primary_images_later(target)
 
     @ classmethod
     def __flush_delete_event__(cls, target):
         super().__flush_delete_event__(target)
         target.clear_mc(target)
+        update_primary_images_later(target)
         image_file = current_app.config["STATIC_DIR"] / target.image
         if image_file.exists():
             image_file.unlink()
@@ -806,19 +1327,23 @@ class Collection(Model):
         return Product.query.filter(Product.id.in_(self.products_ids)).all()
 
     @ property
-    def attr_filter(self):
-        attr_filter = set()
-        for product in self.products:
-            for attr in product.product_type.product_attributes:
-                if attr.title not in ["Size", "Year", "Reference", "Publisher"]:
-                    attr_filter.add(attr)
-        order_of_names = ["Artist", "Technique", "Signature", "Period"]
-
-        def get_sort_index(attr):
-            return order_of_names.index(attr.title) if attr.title in order_of_names else len(order_of_names)
+    @ cache(
+        MC_KEY_COLLECTION_FACETS.format("{self.id}"),
+        namespace=MC_NS_COLLECTION_PRODUCTS.format("{self.id}"),
+    )
+    def facets(self):
+        product_ids = select(ProductCollection.product_id).where(
+            ProductCollection.collection_id == self.id
+        )
+        return product_facets(Product.query.filter(Product.id.in_(product_ids)))
 
-        sorted_attr_filter = sorted(attr_filter, key=get_sort_index)
-        return sorted_attr_filter
+    @ property
+    def attr_filter(self):
+        return facet_attributes(
+            self.facets["type_ids"],
+            ["Size", "Year", "Reference", "Publisher"],
+            ["Artist", "Technique", "Signature", "Period"],
+        )
 
     def update_products(self, new_products):
         origin_ids = (
@@ -858,7 +1383,13 @@ class ProductCollection(Model):
     collection_id = Column(db.Integer())
 
     @ classmethod
-    @ cache_by_args(MC_KEY_COLLECTION_PRODUCTS.format("{collection_id}", "{page}"))
+    @ cache_by_args(
+        MC_KEY_COLLECTION_PRODUCTS.format("{collection_id}", "{page}"),
+        namespace=MC_NS_COLLECTION_PRODUCTS.format("{collection_id}"),
+        single_flight=True,
+        xfetch=1.0,
+        query_args=product_list_args,
+    )
     def get_product_by_collection(cls, collection_id, page):
         collection = Collection.get_by_id(collection_id)
         at_ids = (
@@ -868,18 +1399,14 @@ class ProductCollection(Model):
         )
         query = Product.query.filter(Product.id.in_(id for id, in at_ids))
         ctx, query = get_product_list_context(query, collection)
-        pagination = query.paginate(page, per_page=16)
-        del pagination.query
+        pagination = paginate_products(query, ctx, page)
         ctx.update(object=collection, pagination=pagination,
                    products=pagination.items)
         return ctx
 
     @ staticmethod
     def clear_mc(target):
-        keys = rdb.keys(MC_KEY_COLLECTION_PRODUCTS.format(
-            target.collection_id, "*"))
-        for key in keys:
-            rdb.delete(key)
+        bump_namespace(MC_NS_COLLECTION_PRODUCTS.format(target.collection_id))
 
     @ classmethod
     def __flush_insert_event__(cls, target):
@@ -896,34 +1423,164 @@ class ProductCollection(Model):
         target.clear_mc(target)
 
 
+class CatalogSnapshot:
+    """attributes, their values and product types, loaded together and shared
+    by every request of the process. Without redis a snapshot only lives for
+    one request, as the writes of other processes could not expire it.
+
+    Its instances are detached and shared between threads, read them only;
+    changes go through instances of a session, e.g. `query_values`.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        session = Session(db.engine)
+        try:
+            attributes = session.query(ProductAttribute).order_by(ProductAttribute.id)
+            values = session.query(AttributeChoiceValue).order_by(
+                AttributeChoiceValue.id
+            )
+            types = session.query(ProductType).order_by(ProductType.id)
+            self.attributes = {attr.id: attr for attr in attributes}
+            self.values = {value.id: value for value in values}
+            self.types = {type_.id: type_ for type_ in types}
+            self.type_attributes = self._links(session, ProductTypeAttributes)
+            self.type_variant_attributes = self._links(
+                session, ProductTypeVariantAttributes
+            )
+        finally:
+            session.close()
+
+        self.attribute_values = defaultdict(list)
+        for value in self.values.values():
+            self.attribute_values[value.attribute_id].append(value)
+        self.titles = [attr.title for attr in self.attributes.values()]
+
+    def _links(self, session, link_model):
+        """product type id -> its attributes ordered by id"""
+        links = defaultdict(list)
+        query = session.query(
+            link_model.product_type_id, link_model.product_attribute_id
+        ).order_by(link_model.product_attribute_id)
+        for type_id, attr_id in query:
+            if attr_id in self.attributes:
+                links[type_id].append(self.attributes[attr_id])
+        return links
+
+    def attribute(self, id):
+        return self.attributes.get(int(id)) if is_record_id(id) else None
+
+    def value(self, id):
+        return self.values.get(int(id)) if is_record_id(id) else None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+# bumped by the commits of this process, other processes see MC_NS_CATALOG
+_catalog_generation = 0
+
+
+def _catalog_version():
+    redis_version = _catalog.version[0] if _catalog else 0
+    if breaker.allow():
+        try:
+            redis_version = get_namespace_version(MC_NS_CATALOG)
+            breaker.success()
+        except RedisError:
+            # keep the snapshot we have rather than rebuilding on every call
+            breaker.failure()
+    return redis_version, _catalog_generation
+
+
+def get_catalog():
+    """the current CatalogSnapshot, its version is checked once per request"""
+    if has_request_context() and "catalog" in g:
+        return g.catalog
+    if current_app.config["USE_REDIS"]:
+        catalog = _shared_catalog()
+    else:
+        catalog = CatalogSnapshot(None)
+    if has_request_context():
+        g.catalog = catalog
+    return catalog
+
+
+def _shared_catalog():
+    global _catalog
+    version = _catalog_version()
+    catalog = _catalog
+    if catalog is None or catalog.version != version:
+        with _catalog_lock:
+            if _catalog is None or _catalog.version != version:
+                _catalog = CatalogSnapshot(version)
+            catalog = _catalog
+    return catalog
+
+
+def catalog_changed(target):
+    """flush hook of the models in the snapshot, it is rebuilt after commit"""
+    bump_namespace(MC_NS_CATALOG)
+    object_session(target).info["catalog_changed"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def _expire_catalog(session):
+    global _catalog_generation
+    if session.info.pop("catalog_changed", False):
+        _catalog_generation += 1
+        if has_request_context():
+            g.pop("catalog", None)
+
+
+def product_sort_columns(sort_by):
+    if sort_by in PRODUCT_SORT_COLUMNS:
+        return [getattr(Product, PRODUCT_SORT_COLUMNS[sort_by]), Product.id]
+    return [Product.id]
+
+
+def paginate_products(query, ctx, page, per_page=16):
+    """a page of a get_product_list_context query, by cursor unless an explicit
+    page number is asked for or KEYSET_PAGINATION is off"""
+    if keyset_requested():
+        return keyset_paginate(
+            query,
+            product_sort_columns(ctx["sort_by"]),
+            descending=ctx["is_descending"],
+            cursor=request.args.get("cursor"),
+            per_page=per_page,
+        )
+    pagination = query.paginate(page, per_page=per_page)
+    del pagination.query
+    return pagination
+
+
 def get_product_list_context(query, obj):
     """
-    obj: collection or artist, to get it`s attr_filter.
+    obj: collection or artist, to get it`s attr_filter and facet counts.
     """
     args_dict = {}
     price_from = request.args.get("price_from", "", type=int)
     price_to = request.args.get("price_to", "", type=int)
     if price_from:
-        query = query.filter(Product.basic_price > price_from)
+        query = query.filter(Product.effective_price > price_from)
     if price_to:
-        query = query.filter(Product.basic_price <= price_to)
+        query = query.filter(Product.effective_price <= price_to)
     args_dict.update(price_from=price_from, price_to=price_to)
 
     sort_by_choices = {"title": "title",
                        "basic_price": "price"}
-    arg_sort_by = request.args.get("sort_by", "")
+    arg_sort_by = request.args.get("sort_by", "", type=sort_by_arg)
     is_descending = False
     if arg_sort_by.startswith("-"):
         is_descending = True
         arg_sort_by = arg_sort_by[1:]
-    if arg_sort_by in sort_by_choices:
-        if is_descending:
-            query = query.order_by(desc(getattr(Product, arg_sort_by)))
-        else:
-            query = query.order_by(getattr(Product, arg_sort_by))
+    # the id makes the order total, so pages never overlap
+    columns = product_sort_columns(arg_sort_by)
+    query = query.order_by(*(desc(c) if is_descending else c for c in columns))
     now_sorted_by = arg_sort_by or "title"
     args_dict.update(
         sort_by_choices=sort_by_choices,
+        sort_by=arg_sort_by,
         now_sorted_by=now_sorted_by,
         is_descending=is_descending,
     )
@@ -934,11 +1591,19 @@ def get_product_list_context(query, obj):
         value = request.args.get(attr.title)
         if value:
             query = query.filter(
-                Product.attributes.__getitem__(str(attr.id)) == value)
+                exists().where(
+                    and_(
+                        product_attribute_index.c.product_id == Product.id,
+                        product_attribute_index.c.attribute_id == attr.id,
+                        product_attribute_index.c.value_id == int(value),
+                    )
+                )
+            )
             args_dict["default_attr"].update({attr.title: int(value)})
-    args_dict.update(attr_filter=attr_filter)
+    args_dict.update(attr_filter=attr_filter, facet_counts=obj.facets["counts"])
 
-    if request.args:
+    # only the filtering args, the result is cached per canonical args
+    if price_from or price_to or arg_sort_by or args_dict["default_attr"]:
         args_dict.update(clear_filter=True)
 
     return args_dict, query
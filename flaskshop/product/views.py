@@ -5,6 +5,7 @@ from flask_login import login_required
 from pluggy import HookimplMarker
 
 from flaskshop.checkout.models import Cart
+from flaskshop.corelib.loader import batch
 
 from .forms import AddCartForm
 from .models import Artist, Product, ProductCollection, ProductVariant
@@ -75,26 +76,29 @@ def get_all_variants():
 
 
 def show_all_artists():
-    # page = request.args.get("page", 1, type=int)
-    ctx = Artist.get_all_artists()
+    page = request.args.get("page", 1, type=int)
+    ctx = Artist.get_all_artists(page)
     return render_template("artist/artists.html", **ctx)
 
 
 def show_artist(id):
     page = request.args.get("page", 1, type=int)
     ctx = Artist.get_product_by_artist(id, page)
+    batch(ctx["products"])
     return render_template("artist/index.html", **ctx)
 
 
 def show_artist_by_title(title):
     page = request.args.get("page", 1, type=int)
     ctx = Artist.get_product_by_artist_title(title, page)
+    batch(ctx["products"])
     return render_template("artist/index.html", **ctx)
 
 
 def show_collection(id):
     page = request.args.get("page", 1, type=int)
     ctx = ProductCollection.get_product_by_collection(id, page)
+    batch(ctx["products"])
     return render_template("artist/index.html", **ctx)
 
 
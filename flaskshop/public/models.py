@@ -1,7 +1,7 @@
 from flask import url_for
 
 from flaskshop.corelib.db import PropsItem
-from flaskshop.corelib.mc import cache, rdb
+from flaskshop.corelib.mc import cache, invalidate
 from flaskshop.database import Column, Model, db
 from flaskshop.settings import Config
 
@@ -86,5 +86,6 @@ class Page(Model):
     @classmethod
     def __flush_after_update_event__(cls, target):
         super().__flush_after_update_event__(target)
-        rdb.delete(MC_KEY_PAGE_ID.format(target.id))
-        rdb.delete(MC_KEY_PAGE_ID.format(target.slug))
+        invalidate(
+            MC_KEY_PAGE_ID.format(target.id), MC_KEY_PAGE_ID.format(target.slug)
+        )
@@ -4,11 +4,13 @@ from elasticsearch_dsl import Boolean, Date, Document, Float, Integer, Text
 from elasticsearch_dsl.connections import connections
 from flask_sqlalchemy import Pagination
 
+from flaskshop.corelib.db import PropsMixin
 from flaskshop.settings import Config
 
 connections.create_connection(hosts=Config.ES_HOSTS)
 
 SERACH_FIELDS = ["title^10", "description^5"]
+PREFETCH_SIZE = 1000
 
 
 def get_item_data(item):
@@ -71,16 +73,22 @@ class Item(Document):
     def bulk_update(cls, items, chunk_size=5000, op_type="update", **kwargs):
         index = cls._index._name
         _type = cls._doc_type.name
-        obj = [
-            {
-                "_op_type": op_type,
-                "_id": f"{doc.id}",
-                "_index": index,
-                "_type": _type,
-                "_source": get_item_data(doc),
-            }
-            for doc in items
-        ]
+        items = list(items)
+        obj = []
+        for start in range(0, len(items), PREFETCH_SIZE):
+            chunk = items[start : start + PREFETCH_SIZE]  # noqa: E203
+            # descriptions are props, one redis round trip per chunk
+            PropsMixin.prefetch_props(chunk, ["description"])
+            obj.extend(
+                {
+                    "_op_type": op_type,
+                    "_id": f"{doc.id}",
+                    "_index": index,
+                    "_type": _type,
+                    "_source": get_item_data(doc),
+                }
+                for doc in chunk
+            )
         client = cls.get_es()
         rs = list(parallel_bulk(client, obj, chunk_size=chunk_size, **kwargs))
         return rs
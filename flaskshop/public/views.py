@@ -3,7 +3,9 @@
 from .search import Item
 from .models import Page
 from sqlalchemy.orm import aliased
-from flaskshop.product.models import Product, Artist
+from flaskshop.corelib.loader import batch
+from flaskshop.corelib.paginator import keyset_paginate
+from flaskshop.product.models import Product, Artist, keyset_requested
 from flaskshop.extensions import login_manager
 from flaskshop.account.models import User
 from pluggy import HookimplMarker
@@ -21,7 +23,7 @@ def load_user(user_id):
 
 
 def home():
-    products = Product.get_featured_product()
+    products = batch(Product.get_featured_product())
     return render_template("public/home.html", products=products)
 
 
@@ -45,10 +47,17 @@ def search():
         # Alias the Artist model for use in the subquery
         artist_subquery = aliased(Artist)
 
-        pagination = Product.query.join(artist_subquery, artist_subquery.id == Product.artist_id).filter(
+        products = Product.query.join(artist_subquery, artist_subquery.id == Product.artist_id).filter(
             (Product.title.ilike(query)) | (
                 artist_subquery.title.ilike(query))
-        ).paginate(page)
+        )
+        if keyset_requested():
+            pagination = keyset_paginate(
+                products, [Product.id], cursor=request.args.get("cursor")
+            )
+        else:
+            pagination = products.paginate(page)
+        batch(pagination.items)
 
     return render_template(
         "public/search_result.html",
@@ -33,6 +33,49 @@ class Config:
     #   - save page content
     USE_REDIS = False
     REDIS_URL = os.getenv("REDIS_URI", DBConfig.redis_uri)
+    # a slow redis must not hold requests, connections are capped and commands
+    # time out (seconds) after REDIS_RETRIES retries with exponential backoff
+    REDIS_MAX_CONNECTIONS = 50
+    REDIS_POOL_TIMEOUT = 0.5  # seconds to wait for a free pooled connection
+    REDIS_SOCKET_TIMEOUT = 0.5
+    REDIS_SOCKET_CONNECT_TIMEOUT = 0.5
+    REDIS_RETRIES = 1
+    # after MC_BREAKER_THRESHOLD consecutive redis errors the cache decorators
+    # call the database directly for MC_BREAKER_COOLDOWN seconds
+    MC_BREAKER_THRESHOLD = 5
+    MC_BREAKER_COOLDOWN = 30
+    # keys of a namespaced family are orphaned when its generation is bumped,
+    # so they always get a ttl (seconds) to age out of redis
+    MC_NAMESPACE_EXPIRE = 24 * 60 * 60
+
+    # Process-local LRU cache (props cache), bounded by entries and approximate bytes
+    LOCAL_CACHE_SIZE = 10000
+    LOCAL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    LOCAL_CACHE_EXPIRE = 0  # seconds, 0 means entries only leave by eviction
+
+    # Per-worker L1 in front of redis for the cache decorators, kept coherent
+    # across workers by a redis pub/sub invalidation channel
+    MC_L1_ENABLED = False
+    MC_L1_SIZE = 5000
+    MC_L1_MAX_BYTES = 32 * 1024 * 1024
+    MC_L1_EXPIRE = 5  # seconds, bounds staleness if an invalidation is missed
+    # codec of cached values: "model" (column tuples) or "serializer" (legacy)
+    MC_CODEC = "model"
+    # ttl (seconds) of cached None results, e.g. ids that do not exist
+    MC_NEGATIVE_EXPIRE = 60
+    # single flight recomputation of cache(single_flight=True) keys: the lock
+    # ttl, how long other workers poll for the value and how often (seconds)
+    MC_LOCK_TIMEOUT = 10
+    MC_LOCK_WAIT = 3
+    MC_LOCK_POLL = 0.05
+    # hit/miss/latency counters per key family, kept in-process and added to
+    # redis hashes every MC_STATS_FLUSH_INTERVAL seconds (0 never flushes)
+    MC_STATS_ENABLED = True
+    MC_STATS_FLUSH_INTERVAL = 30
+
+    # product listings and search results page with next/previous cursors
+    # instead of page numbers, ?page=N links are still served with OFFSET
+    KEYSET_PAGINATION = True
 
     # Elasticsearch
     # if elasticsearch is enabled, the home page will have a search bar
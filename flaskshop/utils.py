@@ -82,12 +82,21 @@ def jinja_global_varibles(app):
 
     def get_sort_by_url(field, descending=False):
         request_get = request.args.copy()
+        # positions of the old order mean nothing in the new one
+        request_get.pop("cursor", None)
         if descending:
             request_get["sort_by"] = "-" + field
         else:
             request_get["sort_by"] = field
         return f"{request.path}?{urlencode(request_get)}"
 
+    def get_cursor_url(cursor):
+        request_get = request.args.copy()
+        request_get.pop("page", None)
+        request_get["cursor"] = cursor
+        return f"{request.path}?{urlencode(request_get)}"
+
     app.add_template_global(current_app, "current_app")
     app.add_template_global(get_sort_by_url, "get_sort_by_url")
+    app.add_template_global(get_cursor_url, "get_cursor_url")
     app.add_template_global(template_hook, "run_hook")
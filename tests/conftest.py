@@ -5,6 +5,7 @@ from pathlib import Path
 import pytest
 
 from flaskshop.app import create_app
+from flaskshop.corelib import mc, mc_stats
 from flaskshop.database import db as _db
 from flaskshop.random_data import create_menus, create_products_by_schema
 from flaskshop.utils import jinja_global_varibles
@@ -45,3 +46,28 @@ def db(app):
     # Explicitly close DB connection
     _db.session.close()
     _db.drop_all()
+
+
+@pytest.fixture
+def tables(app):
+    """Empty tables, for tests that create the rows they need."""
+    _db.app = app
+    with app.app_context():
+        _db.create_all()
+
+    yield _db
+
+    _db.session.close()
+    _db.drop_all()
+
+
+@pytest.fixture
+def redis(app, monkeypatch):
+    """The cache decorators on, against an empty fake redis."""
+    import fakeredis
+    client = fakeredis.FakeStrictRedis()
+    app.config.update(USE_REDIS=True, MC_L1_ENABLED=False)
+    monkeypatch.setattr(mc, "rdb", client)
+    monkeypatch.setattr(mc_stats, "rdb", client)
+    monkeypatch.setattr(mc, "breaker", mc.CircuitBreaker())
+    yield client
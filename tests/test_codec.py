@@ -0,0 +1,53 @@
+"""Cache codec unit tests."""
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import inspect
+
+from flaskshop.corelib.codec import CodecError, ModelCodec, get_codec, loads
+from flaskshop.product.models import Artist, Product
+
+
+def make_product(**kwargs):
+    return Product(id=1, title="Sunflowers", basic_price=Decimal("9.50"), **kwargs)
+
+
+class TestModelCodec:
+    """Round trips of mapped instances through the model codec."""
+
+    def test_round_trip(self):
+        codec = ModelCodec()
+        product = make_product(attributes={"1": "2"})
+        loaded = codec.loads(codec.dumps(product))
+        assert type(loaded) is Product
+        assert loaded is not product
+        assert (loaded.id, loaded.title, loaded.basic_price) == (
+            1,
+            "Sunflowers",
+            Decimal("9.50"),
+        )
+        assert loaded.attributes == {"1": "2"}
+        assert inspect(loaded).detached
+
+    def test_nested_instances(self):
+        codec = ModelCodec()
+        artist = Artist(id=3, title="Vincent")
+        value = {"object": artist, "products": [make_product(), make_product()]}
+        loaded = codec.loads(codec.dumps(value))
+        assert loaded["object"].title == "Vincent"
+        assert [p.id for p in loaded["products"]] == [1, 1]
+        # each instance is rebuilt, none is shared with the dumped value
+        assert loaded["products"][0] is not loaded["products"][1]
+
+    def test_schema_change_is_a_miss(self):
+        codec = ModelCodec()
+        data = codec.dumps(make_product())
+        codec.layout(Product).schema_hash += 1
+        with pytest.raises(CodecError):
+            codec.loads(data)
+
+    def test_loads_picks_the_writer(self):
+        data = get_codec("model").dumps([make_product()])
+        assert data.startswith(ModelCodec.magic)
+        assert loads(data)[0].title == "Sunflowers"
+        assert loads(get_codec("serializer").dumps({"a": 1})) == {"a": 1}
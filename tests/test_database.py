@@ -1,9 +1,12 @@
 """Database unit tests."""
 import pytest
+from flask import g
 from flask_login import UserMixin
 from sqlalchemy.orm.exc import ObjectDeletedError
 
-from flaskshop.database import Column, Model, db
+from flaskshop.corelib.mc import NEGATIVE
+from flaskshop.database import MC_KEY_GET_BY_ID, Column, Model, db, identity_map
+from flaskshop.extensions import pending_invalidation
 
 
 class ExampleUserModel(UserMixin, Model):
@@ -65,3 +68,98 @@ class TestPkModel:
     def test_get_by_id_wrong_type(self):
         """Test get_by_id returns None for non-numeric argument."""
         assert ExampleUserModel.get_by_id("xyz") is None
+
+
+@pytest.mark.usefixtures("tables")
+class TestDeferredInvalidation:
+    """Flush hooks clear cached rows once the transaction commits."""
+
+    @pytest.fixture
+    def user(self, redis):
+        user = ExampleUserModel.create(username="foo", email="foo@bar.com")
+        ExampleUserModel.get_by_id(user.id)
+        self.key = MC_KEY_GET_BY_ID.format("ExampleUserModel", user.id)
+        assert redis.exists(self.key)
+        return user
+
+    def test_cleared_on_commit(self, user, redis):
+        user.update(commit=False, username="bar")
+        db.session.flush()
+        assert redis.exists(self.key)
+        db.session.commit()
+        assert not redis.exists(self.key)
+
+    def test_kept_on_rollback(self, user, redis):
+        user.update(commit=False, username="bar")
+        db.session.flush()
+        db.session.rollback()
+        assert redis.exists(self.key)
+        assert not pending_invalidation(db.session).keys
+        # nothing is left over for the next transaction to clear
+        db.session.commit()
+        assert redis.exists(self.key)
+
+
+@pytest.mark.usefixtures("tables")
+class TestIdentityMap:
+    """get_by_id results memoized for the request."""
+
+    def test_same_object(self, redis):
+        user = ExampleUserModel.create(username="foo", email="foo@bar.com")
+        first = ExampleUserModel.get_by_id(user.id)
+        assert ExampleUserModel.get_by_id(user.id) is first
+        assert ExampleUserModel.get_by_id(str(user.id)) is first
+
+    def test_flush_clears(self, redis):
+        user = ExampleUserModel.create(username="foo", email="foo@bar.com")
+        other = ExampleUserModel.create(username="baz", email="baz@bar.com")
+        ExampleUserModel.get_by_id(other.id)
+        assert ("id", ExampleUserModel, other.id) in identity_map()
+        user.update(username="bar")
+        assert ("id", ExampleUserModel, other.id) not in identity_map()
+        assert ExampleUserModel.get_by_id(user.id).username == "bar"
+
+
+@pytest.mark.usefixtures("tables")
+class TestGetMulti:
+    """Batched lookups by id."""
+
+    @pytest.fixture
+    def ids(self, redis):
+        return [
+            ExampleUserModel.create(username=name, email=f"{name}@bar.com").id
+            for name in ("foo", "bar", "baz")
+        ]
+
+    def usernames(self, ids):
+        return [
+            user and user.username for user in ExampleUserModel.get_multi(ids)
+        ]
+
+    def test_order_missing_and_duplicates(self, ids):
+        a, b, c = ids
+        assert self.usernames([c, 999, a, "x", c, b]) == [
+            "baz", None, "foo", None, "baz", "bar"
+        ]
+
+    def test_cached(self, ids, redis):
+        assert self.usernames(ids) == ["foo", "bar", "baz"]
+        for id in ids:
+            assert redis.exists(MC_KEY_GET_BY_ID.format("ExampleUserModel", id))
+        g.pop("identity_map")
+        assert self.usernames(ids[::-1]) == ["baz", "bar", "foo"]
+
+    def test_negative_cached_miss(self, ids, redis):
+        missing = max(ids) + 1
+        assert self.usernames([missing]) == [None]
+        key = MC_KEY_GET_BY_ID.format("ExampleUserModel", missing)
+        assert redis.get(key) == NEGATIVE
+        # inserted behind the flush hooks, the cached miss still answers
+        db.session.execute(
+            ExampleUserModel.__table__.insert().values(
+                id=missing, username="qux", email="qux@bar.com"
+            )
+        )
+        db.session.commit()
+        g.pop("identity_map")
+        assert self.usernames([missing]) == [None]
@@ -0,0 +1,77 @@
+"""Sale pricing tests."""
+from decimal import Decimal
+
+import pytest
+
+from flaskshop.constant import DiscountValueTypeKinds
+from flaskshop.discount.models import Sale, SaleArtist, SaleProduct
+from flaskshop.product.models import Artist, Product
+
+
+def price_of(product):
+    return Product.query.get(product.id).price
+
+
+@pytest.mark.usefixtures("tables")
+class TestReprice:
+    """Effective prices follow the sales of a product and its artist."""
+
+    @pytest.fixture
+    def product(self):
+        artist = Artist.create(title="Reprice")
+        return Product.create(
+            title="Reprice",
+            basic_price=Decimal("20.00"),
+            artist_id=artist.id,
+            attributes={},
+        )
+
+    def test_product_sale_edit_and_delete(self, product):
+        assert price_of(product) == Decimal("20.00")
+        sale = Sale.create(
+            title="Ten off",
+            discount_value_type=DiscountValueTypeKinds.percent.value,
+            discount_value=Decimal("10"),
+        )
+        SaleProduct.create(sale_id=sale.id, product_id=product.id)
+        assert price_of(product) == Decimal("18.00")
+
+        sale.update(discount_value=Decimal("25"))
+        assert price_of(product) == Decimal("15.00")
+
+        sale.delete()
+        assert price_of(product) == Decimal("20.00")
+
+    def test_product_sale_wins_over_artist_sale(self, product):
+        artist_sale = Sale.create(
+            title="Artist",
+            discount_value_type=DiscountValueTypeKinds.fixed.value,
+            discount_value=Decimal("5"),
+        )
+        sale_artist = SaleArtist.create(
+            sale_id=artist_sale.id, artist_id=product.artist_id
+        )
+        assert price_of(product) == Decimal("15.00")
+
+        product_sale = Sale.create(
+            title="Product",
+            discount_value_type=DiscountValueTypeKinds.fixed.value,
+            discount_value=Decimal("2"),
+        )
+        sale_product = SaleProduct.create(sale_id=product_sale.id, product_id=product.id)
+        assert price_of(product) == Decimal("18.00")
+
+        sale_product.delete()
+        assert price_of(product) == Decimal("15.00")
+        sale_artist.delete()
+        assert price_of(product) == Decimal("20.00")
+
+    def test_basic_price_change(self, product):
+        sale = Sale.create(
+            title="Half",
+            discount_value_type=DiscountValueTypeKinds.percent.value,
+            discount_value=Decimal("50"),
+        )
+        SaleProduct.create(sale_id=sale.id, product_id=product.id)
+        product.update(basic_price=Decimal("30.00"))
+        assert price_of(product) == Decimal("15.00")
@@ -0,0 +1,41 @@
+"""Local cache unit tests."""
+import time
+
+from flaskshop.corelib.local_cache import LocalCache
+
+
+class TestLocalCache:
+    """LRU, ttl and byte budget tests."""
+
+    def test_evicts_least_recently_used(self):
+        cache = LocalCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get_multi(["a", "c"]) == {"a": 1, "c": 3}
+        assert cache.evictions == 1
+
+    def test_expire(self, monkeypatch):
+        cache = LocalCache()
+        cache.set("a", 1, time=10)
+        now = time.monotonic()
+        monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+        assert cache.get("a") is None
+        assert cache.misses == 1
+
+    def test_byte_budget(self):
+        cache = LocalCache(max_bytes=2000)
+        cache.set("a", "x" * 1000)
+        cache.set("b", "y" * 1000)
+        assert cache.get("a") is None
+        assert cache.get("b") is not None
+        assert cache.nbytes <= 2000
+
+    def test_delete(self):
+        cache = LocalCache()
+        cache.set("a", {"k": "v"})
+        cache.delete("a")
+        assert cache.get("a") is None
+        assert cache.nbytes == 0
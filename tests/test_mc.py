@@ -0,0 +1,57 @@
+"""Cache decorator unit tests, against fakeredis."""
+from redis.exceptions import ConnectionError
+
+from flaskshop.corelib import mc
+from flaskshop.settings import Config
+
+
+def counted(f):
+    def _(*a):
+        _.calls += 1
+        return f(*a)
+
+    _.calls = 0
+    return _
+
+
+class TestCache:
+    """Hits, misses and redis failures of the cache decorator."""
+
+    def test_hit(self, redis):
+        square = counted(lambda n: [n * n])
+        cached = mc.cache("test:square:{n}")(lambda n: square(n))
+        assert cached(3) == [9]
+        assert cached(3) == [9]
+        assert square.calls == 1
+
+    def test_negative(self, redis):
+        nothing = counted(lambda n: None)
+        cached = mc.cache("test:nothing:{n}", expire=3600)(lambda n: nothing(n))
+        assert cached(1) is None
+        assert cached(1) is None
+        assert nothing.calls == 1
+        assert redis.get("test:nothing:1") == mc.NEGATIVE
+        assert redis.ttl("test:nothing:1") <= Config.MC_NEGATIVE_EXPIRE
+
+    def test_store_failure_computes_once(self, redis, monkeypatch):
+        square = counted(lambda n: [n * n])
+        cached = mc.cache("test:square:{n}")(lambda n: square(n))
+
+        def down(*a, **kw):
+            raise ConnectionError("down")
+
+        monkeypatch.setattr(redis, "set", down)
+        assert cached(4) == [16]
+        assert square.calls == 1
+        assert mc.breaker.failures == 1
+
+    def test_lookup_failure_falls_back(self, redis, monkeypatch):
+        square = counted(lambda n: [n * n])
+        cached = mc.cache("test:square:{n}")(lambda n: square(n))
+
+        def down(*a, **kw):
+            raise ConnectionError("down")
+
+        monkeypatch.setattr(redis, "get", down)
+        assert cached(5) == [25]
+        assert square.calls == 1
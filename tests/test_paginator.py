@@ -0,0 +1,111 @@
+"""Keyset pagination tests."""
+import base64
+from decimal import Decimal
+
+import pytest
+
+from flaskshop.corelib.paginator import encode_cursor, keyset_paginate, parse_cursor
+from flaskshop.database import db
+from flaskshop.product.models import Artist, Product
+
+COLUMNS = [Product.effective_price, Product.id]
+
+
+def raw_cursor(data):
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+class TestParseCursor:
+    """Cursors are parsed against the sort columns of the listing."""
+
+    def test_round_trip(self):
+        cursor = encode_cursor([Decimal("9.50"), 3], backwards=True)
+        assert parse_cursor(cursor, COLUMNS) == (True, [Decimal("9.50"), 3])
+
+    def test_null_sort_key(self):
+        assert parse_cursor(encode_cursor([None, 3]), COLUMNS) == (False, [None, 3])
+
+    @pytest.mark.parametrize(
+        "cursor",
+        [
+            "!!garbage",
+            raw_cursor("not json"),
+            raw_cursor("null"),
+            raw_cursor('"x"'),
+            raw_cursor('{"a":1}'),
+            raw_cursor("[[1]]"),
+            raw_cursor("[2,1,1]"),
+            raw_cursor("[0,1]"),
+            raw_cursor("[0,1,2,3]"),
+            raw_cursor('[0,"x",1]'),
+            raw_cursor('[0,"NaN",1]'),
+            raw_cursor("[0,1e400,1]"),
+            raw_cursor("[0,[1],1]"),
+            raw_cursor('[0,"1","x"]'),
+            raw_cursor("[0,1,null]"),
+        ],
+    )
+    def test_bad(self, cursor):
+        with pytest.raises(ValueError):
+            parse_cursor(cursor, COLUMNS)
+
+
+@pytest.mark.usefixtures("tables")
+class TestKeysetPaginate:
+    """Walking the pages of a listing by their cursors."""
+
+    @pytest.fixture
+    def ids(self):
+        prices = [None, "5.00", None, "5.00", "7.00", None, "3.00"]
+        self.artist = Artist.create(title="Keyset")
+        rows = []
+        for i, price in enumerate(prices):
+            product = Product.create(
+                title=f"P{i}", basic_price=1, artist_id=self.artist.id, attributes={}
+            )
+            price = price and Decimal(price)
+            rows.append((price is not None, price, product.id))
+            # as before the effective_price backfill, some are NULL
+            db.session.execute(
+                Product.__table__.update()
+                .where(Product.id == product.id)
+                .values(effective_price=price)
+            )
+        db.session.commit()
+        # NULL first, then by price and id
+        return [id for _, _, id in sorted(rows, key=lambda r: (r[0], r[1] or 0, r[2]))]
+
+    @property
+    def query(self):
+        return Product.query.filter_by(artist_id=self.artist.id)
+
+    def walk(self, descending):
+        seen, cursor = [], None
+        while True:
+            page = keyset_paginate(
+                self.query, COLUMNS, descending, cursor=cursor, per_page=2
+            )
+            seen.extend(p.id for p in page.items)
+            if not page.has_next:
+                return seen, page
+            cursor = page.next_cursor
+
+    def test_ascending(self, ids):
+        assert self.walk(False)[0] == ids
+
+    def test_descending(self, ids):
+        assert self.walk(True)[0] == ids[::-1]
+
+    def test_back(self, ids):
+        _, last = self.walk(False)
+        page = keyset_paginate(
+            self.query, COLUMNS, cursor=last.prev_cursor, per_page=2
+        )
+        assert [p.id for p in page.items] == ids[-3:-1]
+
+    def test_bad_cursor_gives_first_page(self, ids):
+        page = keyset_paginate(
+            self.query, COLUMNS, cursor=raw_cursor('[0,"x",1]'), per_page=2
+        )
+        assert [p.id for p in page.items] == ids[:2]
+        assert not page.has_prev